@@ -0,0 +1,453 @@
+"""Offline end-to-end benchmark of the journal flows.
+
+Drives the real handlers from bot.py against in-process stand-ins for the
+Telegram bot API and the Drive/Docs REST API, and reports reply latency
+(p50/p99), journal writes per second and peak memory for the text,
+reflection and media flows:
+
+    python benchmarks/journal.py --chats 20 --rounds 10 --google-latency-ms 80
+
+Everything runs in a temporary directory with a throwaway service account,
+nothing leaves the machine. --google-failure-rate makes that share of Google
+calls fail with a 503 to exercise the outbox retries.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from itertools import count
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from telegram import Update
+from telegram.request import BaseRequest
+
+from startup import REPO_ROOT, fake_service_account
+
+BOT_ID = 1000
+
+
+class FakeGoogle(object):
+    # The slice of the Drive v3 and Docs v1 REST APIs the bot uses, served
+    # in-process. Shared by every transport the bot's http pool creates.
+
+    def __init__(self, latency, jitter, failure_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.failures = 0
+        self.inserts = 0
+        self.uploaded_bytes = 0
+        self._ids = count(1)
+        self._documents = {}
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def http(self):
+        return FakeGoogleHttp(self)
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        # runs on the bot's worker threads, so latency blocks like a real call
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+        with self._lock:
+            self.calls += 1
+            if random.random() < self.failure_rate:
+                self.failures += 1
+                return _google_response(
+                    503, {"error": {"code": 503, "message": "Backend Error"}}
+                )
+            return self._route(urlparse(uri), method, body)
+
+    def _route(self, url, method, body):
+        query = parse_qs(url.query)
+
+        if url.path == "/drive/v3/files" and method == "POST":
+            metadata = json.loads(body)
+            file_id = "file{}".format(next(self._ids))
+            if metadata.get("mimeType") == "application/vnd.google-apps.document":
+                # a new document holds one empty paragraph
+                self._documents[file_id] = 1
+            return _google_response(200, {"id": file_id, "name": metadata["name"]})
+
+        if url.path == "/upload/drive/v3/files" and method == "POST":
+            upload_id = str(next(self._ids))
+            self._uploads[upload_id] = json.loads(body or "{}").get("name")
+            location = "https://www.googleapis.com/upload/drive/v3/files?{}".format(
+                "uploadType=resumable&upload_id=" + upload_id
+            )
+            return _google_response(200, {}, location=location)
+
+        if url.path == "/upload/drive/v3/files" and method == "PUT":
+            name = self._uploads.pop(query["upload_id"][0])
+            # resumable chunks arrive as a stream over the spooled file
+            data = body.read() if hasattr(body, "read") else body or b""
+            self.uploaded_bytes += len(data)
+            file_id = "file{}".format(next(self._ids))
+            return _google_response(200, {"id": file_id, "name": name})
+
+        if url.path.startswith("/v1/documents/"):
+            document_id = url.path[len("/v1/documents/") :]
+            if method == "POST" and document_id.endswith(":batchUpdate"):
+                document_id = document_id[: -len(":batchUpdate")]
+                for request in json.loads(body)["requests"]:
+                    text = request.get("insertText", {}).get("text")
+                    if text is not None:
+                        self._documents[document_id] += (
+                            len(text.encode("utf-16-le")) // 2
+                        )
+                        self.inserts += 1
+                return _google_response(200, {"documentId": document_id})
+
+            end_index = self._documents.setdefault(document_id, 1)
+            return _google_response(
+                200, {"body": {"content": [{"endIndex": end_index + 1}]}}
+            )
+
+        return _google_response(404, {"error": {"code": 404, "message": url.path}})
+
+
+class FakeGoogleHttp(object):
+    # stands in for an authorized httplib2.Http
+    def __init__(self, google):
+        self.google = google
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        return self.google.request(uri, method=method, body=body, headers=headers)
+
+
+def _google_response(status, payload, **headers):
+    headers.update(status=str(status), **{"content-type": "application/json"})
+    return httplib2.Response(headers), json.dumps(payload).encode("utf-8")
+
+
+class FakeBotApi(BaseRequest):
+    # answers bot API calls locally; sent messages are handed to on_send
+    def __init__(self, latency, on_send):
+        self.latency = latency
+        self.on_send = on_send
+        self.files = {}
+        self._message_ids = count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data is not None else {}
+        api_method = url.rsplit("/", 1)[-1]
+
+        if api_method == "getMe":
+            result = {
+                "id": BOT_ID,
+                "is_bot": True,
+                "first_name": "Eva",
+                "username": "eva_benchmark_bot",
+            }
+        elif api_method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": BOT_ID, "is_bot": True, "first_name": "Eva"},
+                "text": params.get("text", ""),
+            }
+            self.on_send(chat_id, params.get("text", ""))
+        elif api_method == "getFile":
+            file_id = params["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": os.path.getsize(self.files[file_id]),
+                # an existing local path is read directly, as with a local
+                # bot API server
+                "file_path": self.files[file_id],
+            }
+        else:
+            result = True
+
+        return 200, json.dumps({"ok": True, "result": result}).encode("utf-8")
+
+
+class Chat(object):
+    # one simulated user, sending updates and waiting for the bot's replies
+    def __init__(self, application, chat_id):
+        self.application = application
+        self.chat_id = chat_id
+        self.inbox = asyncio.Queue()
+        self._message_ids = count(1)
+
+    async def send(self, replies=1, **message):
+        # returns the time until each of the expected replies arrived
+        message.update(
+            message_id=next(self._message_ids),
+            date=int(time.time()),
+            chat={"id": self.chat_id, "type": "private"},
+        )
+        message["from"] = {"id": self.chat_id, "is_bot": False, "first_name": "Ada"}
+        if message.get("text", "").startswith("/"):
+            command = message["text"].split()[0]
+            message["entities"] = [
+                {"type": "bot_command", "offset": 0, "length": len(command)}
+            ]
+
+        update = Update.de_json(
+            {"update_id": next(UPDATE_IDS), "message": message},
+            self.application.bot,
+        )
+        started = time.perf_counter()
+        await self.application.update_queue.put(update)
+
+        latencies = []
+        for _ in range(replies):
+            await self.inbox.get()
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+
+UPDATE_IDS = count(1)
+# chat id -> Chat, for routing the bot's messages
+CHATS = {}
+
+
+async def text_flow(chat, rounds, results, media):
+    for i in range(rounds):
+        results["reply"] += await chat.send(text="Share a Thought")
+        results["reply"] += await chat.send(text="Benchmark thought {} 📝".format(i))
+
+
+async def reflection_flow(chat, rounds, results, media):
+    for i in range(rounds):
+        results["reply"] += await chat.send(text="Answer a Reflection Question")
+        results["reply"] += await chat.send(text="Benchmark reflection {}".format(i))
+
+
+async def media_flow(chat, rounds, results, media):
+    for i in range(rounds):
+        results["reply"] += await chat.send(text="Share a Photo")
+
+        file_id = "photo-{}-{}".format(chat.chat_id, i)
+        path = os.path.join(media["directory"], file_id + ".jpg")
+        with open(path, "wb") as fp:
+            fp.write(os.urandom(media["size"]))
+        media["paths"][file_id] = path
+
+        received, saved = await chat.send(
+            replies=2,
+            photo=[
+                {
+                    "file_id": file_id,
+                    "file_unique_id": file_id,
+                    "width": 1280,
+                    "height": 960,
+                    "file_size": media["size"],
+                }
+            ],
+        )
+        results["reply"].append(received)
+        results["media_saved"].append(saved)
+
+
+FLOWS = {"text": text_flow, "reflection": reflection_flow, "media": media_flow}
+
+
+async def run_flow(bot, application, google, name, chat_ids, args, media):
+    chats = [Chat(application, chat_id) for chat_id in chat_ids]
+    CHATS.update((chat.chat_id, chat) for chat in chats)
+    for chat in chats:
+        await chat.send(replies=3, text="/start")
+
+    results = {"reply": [], "media_saved": []}
+    inserts = google.inserts
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(FLOWS[name](chat, args.rounds, results, media) for chat in chats)
+    )
+    replied = time.perf_counter()
+
+    # journal writes are done once the writer and the outbox are drained
+    while bot.journal.depth or bot.outbox.pending():
+        bot.outbox.notify()
+        await asyncio.sleep(0.01)
+    drained = time.perf_counter()
+
+    writes = google.inserts - inserts
+    report = {
+        "flow": name,
+        "replies": len(results["reply"]),
+        "p50_ms": percentile(results["reply"], 50) * 1000,
+        "p99_ms": percentile(results["reply"], 99) * 1000,
+        "replies_per_s": len(results["reply"]) / (replied - started),
+        "writes": writes,
+        "writes_per_s": writes / (drained - started),
+        "max_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if tracemalloc.is_tracing():
+        report["traced_peak_mib"] = tracemalloc.get_traced_memory()[1] / 2**20
+    if results["media_saved"]:
+        report["saved_p50_ms"] = percentile(results["media_saved"], 50) * 1000
+        report["saved_p99_ms"] = percentile(results["media_saved"], 99) * 1000
+    return report
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(len(ordered) * p / 100) - 1, 0)]
+
+
+async def run(args, workdir):
+    import bot
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    google = FakeGoogle(
+        args.google_latency_ms / 1000,
+        args.google_jitter_ms / 1000,
+        args.google_failure_rate,
+    )
+    bot.conversation.goog_drive.http_pool._new_http = google.http
+
+    def on_send(chat_id, text):
+        chat = CHATS.get(chat_id)
+        if chat is not None:
+            chat.inbox.put_nowait(text)
+
+    api = FakeBotApi(args.telegram_latency_ms / 1000, on_send)
+    application = bot.build_application(request=api)
+
+    media = {
+        "directory": os.path.join(workdir, "telegram-files"),
+        "size": args.media_kb * 1024,
+        "paths": api.files,
+    }
+    os.makedirs(media["directory"])
+
+    reports = []
+    try:
+        async with application:
+            await application.post_init(application)
+            await application.start()
+            for number, name in enumerate(args.flows):
+                first_chat_id = (number + 1) * 100000
+                chat_ids = range(first_chat_id, first_chat_id + args.chats)
+                reports.append(
+                    await run_flow(
+                        bot, application, google, name, chat_ids, args, media
+                    )
+                )
+            await application.stop()
+    finally:
+        await application.post_shutdown(application)
+
+    reports.append(
+        {"google_calls": google.calls, "google_failures": google.failures}
+    )
+    return reports
+
+
+def print_reports(reports):
+    flows = [report for report in reports if "flow" in report]
+    columns = [
+        (name, width, precision)
+        for name, width, precision in (
+            ("flow", 11, None),
+            ("replies", 8, None),
+            ("p50_ms", 8, 1),
+            ("p99_ms", 8, 1),
+            ("replies_per_s", 14, 1),
+            ("writes_per_s", 13, 1),
+            ("max_rss_mib", 12, 1),
+            ("traced_peak_mib", 16, 1),
+            ("saved_p50_ms", 13, 1),
+            ("saved_p99_ms", 13, 1),
+        )
+        if any(name in report for report in flows)
+    ]
+
+    print(" ".join(name.rjust(width) for name, width, _ in columns))
+    for report in flows:
+        cells = []
+        for name, width, precision in columns:
+            value = report.get(name, "")
+            if precision is not None and value != "":
+                value = "{:.{}f}".format(value, precision)
+            cells.append(str(value).rjust(width))
+        print(" ".join(cells))
+    print(
+        "google calls: {google_calls}, injected failures: {google_failures}".format(
+            **reports[-1]
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument(
+        "--flows", type=lambda value: value.split(","), default=list(FLOWS)
+    )
+    parser.add_argument("--google-latency-ms", type=float, default=80)
+    parser.add_argument("--google-jitter-ms", type=float, default=20)
+    parser.add_argument("--google-failure-rate", type=float, default=0.0)
+    parser.add_argument("--telegram-latency-ms", type=float, default=30)
+    parser.add_argument("--media-kb", type=int, default=256)
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="track peak python allocations per flow (slows everything down)",
+    )
+    parser.add_argument("--json", action="store_true", help="print raw results")
+    args = parser.parse_args()
+
+    unknown = set(args.flows) - set(FLOWS)
+    if unknown:
+        parser.error("unknown flows: {}".format(", ".join(sorted(unknown))))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        fake_service_account("service-account.json")
+        os.environ.update(
+            SERVICE_ACCOUNT_FILE=os.path.join(workdir, "service-account.json"),
+            TELEGRAM_BOT_TOKEN="{}:benchmark".format(BOT_ID),
+            BOT_NAME="eva",
+            GOOGLE_DRIVE_PARENT_FOLDER_ID="benchmark-root",
+            REFLECTION_QUESTIONS_FILE=os.path.join(
+                REPO_ROOT, "reflection-questions.txt"
+            ),
+            OUTBOX_RETRY_BASE_SECONDS=os.getenv("OUTBOX_RETRY_BASE_SECONDS", "0.2"),
+            OUTBOX_RETRY_MAX_SECONDS=os.getenv("OUTBOX_RETRY_MAX_SECONDS", "2"),
+        )
+        sys.path.insert(0, REPO_ROOT)
+
+        if args.trace_memory:
+            tracemalloc.start()
+        reports = asyncio.run(run(args, workdir))
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print_reports(reports)
+
+
+if __name__ == "__main__":
+    main()
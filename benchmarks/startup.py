@@ -0,0 +1,140 @@
+"""Measure how long the bot takes to come up after a cold start.
+
+Every run is a fresh interpreter in an empty working directory (so
+journal.sqlite is created from scratch), timing each startup stage:
+
+    python benchmarks/startup.py --runs 5 --offline
+
+--offline makes any attempt to open a network connection during startup
+fail the run. Without --service-account-file a throwaway key is generated.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def fake_service_account(path):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode("ascii")
+
+    with open(path, "w") as fp:
+        json.dump(
+            {
+                "type": "service_account",
+                "project_id": "startup-benchmark",
+                "private_key_id": "0",
+                "private_key": private_key,
+                "client_email": "bench@startup-benchmark.iam.gserviceaccount.com",
+                "client_id": "0",
+                "token_uri": "https://oauth2.googleapis.com/token",
+            },
+            fp,
+        )
+
+
+def block_network():
+    def connect(self, address):
+        raise OSError("network access during startup: {!r}".format(address))
+
+    socket.socket.connect = connect
+    socket.socket.connect_ex = connect
+
+
+def run_child(offline):
+    # one cold start; prints the stage timings as json
+    if offline:
+        block_network()
+    sys.path.insert(0, REPO_ROOT)
+
+    timings = {}
+    started = time.perf_counter()
+
+    def mark(stage):
+        timings[stage] = time.perf_counter() - started
+
+    import telegram.ext  # noqa: F401
+
+    mark("import_telegram")
+
+    import bot
+
+    mark("import_bot")
+
+    bot.conversation.get_reflection_question()
+    bot.conversation.day_resolver(0)
+    mark("ready")
+
+    # first use of the google clients, normally paid by the first write
+    bot.conversation.goog_drive.drive_service
+    bot.conversation.goog_drive.docs_service
+    mark("google_clients")
+
+    print(json.dumps(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--service-account-file")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.offline)
+        return
+
+    results = []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            service_account_file = args.service_account_file
+            if service_account_file is None:
+                service_account_file = os.path.join(workdir, "service-account.json")
+                fake_service_account(service_account_file)
+
+            env = dict(
+                os.environ,
+                SERVICE_ACCOUNT_FILE=os.path.abspath(service_account_file),
+                REFLECTION_QUESTIONS_FILE=os.path.join(
+                    REPO_ROOT, "reflection-questions.txt"
+                ),
+                BOT_NAME=os.getenv("BOT_NAME", "eva"),
+            )
+            command = [sys.executable, os.path.abspath(__file__), "--child"]
+            if args.offline:
+                command.append("--offline")
+
+            output = subprocess.run(
+                command, cwd=workdir, env=env, capture_output=True, text=True
+            )
+            if output.returncode != 0:
+                sys.exit(output.stderr)
+            results.append(json.loads(output.stdout.splitlines()[-1]))
+
+    print("{:<16} {:>10} {:>10}".format("stage", "median ms", "max ms"))
+    for stage in results[0]:
+        values = [result[stage] * 1000 for result in results]
+        print(
+            "{:<16} {:>10.1f} {:>10.1f}".format(
+                stage, statistics.median(values), max(values)
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,41 @@
+import asyncio
+import html
 import logging
 import os
 import random
-from datetime import datetime, time
-from zoneinfo import ZoneInfo
-
+import secrets
+import sys
+import tempfile
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfoNotFoundError
+
+import export
+import media_spool
+import metrics
+from broadcast import Broadcaster
 from conversation import Conversation
+from database import db_session
 from dotenv import load_dotenv
+from journal_search import HIGHLIGHT
+from loop_watchdog import LoopWatchdog
+from media_uploader import MediaUploader
+from outbox import OutboxWorker
+from persistence import SQLitePersistence
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.error import Forbidden
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
-    PicklePersistence,
     filters,
 )
-from utils import period_of_day
+from telegram_request import InstrumentedHTTPXRequest
+from update_processor import ChatOrderedUpdateProcessor
+from utils import get_timezone, period_of_day
+from webhook import run_webhook
+from write_queue import WriteBehindQueue
 
 # ----------------------- Setup & Config -----------------------
 
@@ -29,6 +48,58 @@ load_dotenv(".env")
 conversation = Conversation(
     service_account_file=os.getenv("SERVICE_ACCOUNT_FILE"),
     drive_folder_parent_id=os.getenv("GOOGLE_DRIVE_PARENT_FOLDER_ID"),
+    reflection_question_data_file=os.getenv(
+        "REFLECTION_QUESTIONS_FILE", "reflection-questions.txt"
+    ),
+    timezone=os.getenv("TIMEZONE"),
+)
+outbox = OutboxWorker(conversation)
+journal = WriteBehindQueue(conversation, on_flush=outbox.notify)
+media_uploader = MediaUploader(conversation, journal, outbox=outbox)
+broadcaster = Broadcaster()
+loop_watchdog = LoopWatchdog()
+
+# chats allowed to use /perf
+ADMIN_CHAT_IDS = [
+    int(chat_id) for chat_id in os.getenv("ADMIN_CHAT_IDS", "").split(",") if chat_id
+]
+
+
+def outbox_backlog() -> int:
+    # ends the read so the calling thread's session holds no sqlite snapshot
+    pending = outbox.pending()
+    conversation.db_session.commit()
+    return pending
+
+
+async def read_journal(query, *args):
+    # runs a database read on a worker thread, off the event loop, and hands
+    # back that thread's session so idle executor threads hold no connection
+    def run():
+        try:
+            return query(*args)
+        finally:
+            db_session.remove()
+
+    return await asyncio.to_thread(run)
+
+
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "journal_queue_depth",
+        "Journal writes waiting for the writer.",
+        lambda: journal.depth,
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge(
+        "media_uploads_in_flight",
+        "Media files being downloaded or uploaded.",
+        lambda: media_uploader.in_flight,
+    )
+)
+metrics.REGISTRY.register(
+    metrics.Gauge("outbox_pending", "Outbox rows waiting for delivery.", outbox_backlog)
 )
 
 CHOOSING, TYPING_REPLY, TYPING_CHOICE, MEDIA = range(4)
@@ -48,63 +119,69 @@ markup = ReplyKeyboardMarkup(
 # ----------------------- Helpers -----------------------
 
 
-def remove_job_if_exists(name: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    jobs = context.job_queue.get_jobs_by_name(name)
-    if not jobs:
-        return False
-    for job in jobs:
-        job.schedule_removal()
-    return True
+PROMPT_BUCKET_MINUTES = 15
+DAILY_PROMPT_JOB_NAME = "daily-prompts"
 
 
-def configured_timezone() -> ZoneInfo | None:
-    timezone_name = os.getenv("TIMEZONE")
+def parse_timezone(timezone_name: str | None) -> str | None:
+    # returns the name back if it is a valid zone, cached by get_timezone
     if not timezone_name:
         return None
-
     try:
-        return ZoneInfo(timezone_name)
-    except Exception:
-        logging.warning("Invalid TIMEZONE %r. Falling back to server local time.", timezone_name)
+        get_timezone(timezone_name)
+    except (ValueError, ZoneInfoNotFoundError):
         return None
+    return timezone_name
 
 
-def configured_daily_prompt_time() -> time:
-    raw_value = os.getenv("DAILY_PROMPT_TIME", "18:00")
-
+def parse_prompt_time(raw_value: str) -> time | None:
+    # HH:MM, rounded down to the quarter hour the prompt is sent in
     try:
         hour_text, minute_text = raw_value.split(":", 1)
-        return time(
-            hour=int(hour_text),
-            minute=int(minute_text),
-            tzinfo=configured_timezone(),
-        )
+        prompt_time = time(hour=int(hour_text), minute=int(minute_text))
     except (TypeError, ValueError):
-        logging.warning(
-            "Invalid DAILY_PROMPT_TIME %r. Falling back to 18:00.", raw_value
-        )
-        return time(hour=18, minute=0, tzinfo=configured_timezone())
-
+        return None
+    return prompt_time.replace(
+        minute=prompt_time.minute - prompt_time.minute % PROMPT_BUCKET_MINUTES
+    )
 
-def daily_prompt_job_name(chat_id: int) -> str:
-    return f"daily-prompt:{chat_id}"
 
+DEFAULT_TIMEZONE = parse_timezone(os.getenv("TIMEZONE"))
+if os.getenv("TIMEZONE") and DEFAULT_TIMEZONE is None:
+    logging.warning(
+        "Invalid TIMEZONE %r. Falling back to server local time.", os.getenv("TIMEZONE")
+    )
 
-def schedule_daily_prompt(chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
-    remove_job_if_exists(daily_prompt_job_name(chat_id), context)
-    context.job_queue.run_daily(
-        initiate_conversation,
-        time=configured_daily_prompt_time(),
-        chat_id=chat_id,
-        name=daily_prompt_job_name(chat_id),
+DEFAULT_PROMPT_TIME = parse_prompt_time(os.getenv("DAILY_PROMPT_TIME", "18:00"))
+if DEFAULT_PROMPT_TIME is None:
+    logging.warning(
+        "Invalid DAILY_PROMPT_TIME %r. Falling back to 18:00.",
+        os.getenv("DAILY_PROMPT_TIME"),
     )
+    DEFAULT_PROMPT_TIME = time(hour=18)
+
+
+def chat_timezone(chat_data) -> str | None:
+    return chat_data.get("timezone") or DEFAULT_TIMEZONE
+
+
+def chat_prompt_time(chat_data) -> time:
+    prompt_time = chat_data.get("daily_prompt_time")
+    return parse_prompt_time(prompt_time) if prompt_time else DEFAULT_PROMPT_TIME
 
 
-def daily_prompt_status_text() -> str:
-    timezone_name = os.getenv("TIMEZONE") or "server local time"
+def chat_now(chat_data) -> datetime:
+    timezone_name = chat_timezone(chat_data)
+    if timezone_name:
+        return datetime.now(get_timezone(timezone_name))
+    return datetime.now()
+
+
+def daily_prompt_status_text(chat_data) -> str:
+    timezone_name = chat_timezone(chat_data) or "server local time"
     return (
         f"I’ll send a journal prompt every day at "
-        f"{configured_daily_prompt_time().strftime('%H:%M')} ({timezone_name})."
+        f"{chat_prompt_time(chat_data).strftime('%H:%M')} ({timezone_name})."
     )
 
 
@@ -141,8 +218,8 @@ ANYTIME_CHECKINS = [
 SUGGESTED_TAGS = ["#win", "#mood", "#gratitude", "#note", "#focus"]
 
 
-def pick_timebox_prompts():
-    p = period_of_day(os.getenv("TIMEZONE"))
+def pick_timebox_prompts(timezone_name=None):
+    p = period_of_day(timezone_name)
     if p == "morning":
         base = MORNING_PROMPTS
     elif p in ("noon", "afternoon"):
@@ -154,9 +231,9 @@ def pick_timebox_prompts():
     return prompts
 
 
-def format_daily_prompt(first_name: str) -> str:
-    today = datetime.now().strftime("%b %d")
-    prompts = pick_timebox_prompts()
+def format_daily_prompt(first_name: str, chat_data) -> str:
+    today = chat_now(chat_data).strftime("%b %d")
+    prompts = pick_timebox_prompts(chat_timezone(chat_data))
     tags = " ".join(random.sample(SUGGESTED_TAGS, k=3))
     return (
         f"📝 *Daily Journal* — {today}\n"
@@ -168,8 +245,8 @@ def format_daily_prompt(first_name: str) -> str:
     )
 
 
-def greeting():
-    p = period_of_day(os.getenv("TIMEZONE"))
+def greeting(timezone_name=None):
+    p = period_of_day(timezone_name)
     if p == "morning":
         return random.choice(
             ["Morning! How’s it going?", "Hey—did you sleep okay?", "What’s up today?"]
@@ -198,30 +275,36 @@ def greeting():
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     chat_id = update.effective_message.chat_id
     context.chat_data["daily_prompt_enabled"] = True
-    schedule_daily_prompt(chat_id, context)
 
     reply_text = (
         f"Hey there {update.effective_user.first_name}, I’m {os.getenv('BOT_NAME')} 🙂 "
         "Want to share anything from today?"
     )
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text, reply_markup=markup)
 
     # also send today’s prompt (short & friendly)
-    prompt_text = format_daily_prompt(update.effective_user.first_name)
-    conversation.add_content(
-        os.getenv("BOT_NAME"), prompt_text, is_bot=True, category="prompt"
+    prompt_text = format_daily_prompt(
+        update.effective_user.first_name, context.chat_data
+    )
+    await journal.add_content(
+        chat_id, os.getenv("BOT_NAME"), prompt_text, is_bot=True, category="prompt"
     )
     await update.message.reply_text(prompt_text, parse_mode="Markdown")
-    await update.message.reply_text(daily_prompt_status_text(), reply_markup=markup)
+    await update.message.reply_text(
+        daily_prompt_status_text(context.chat_data), reply_markup=markup
+    )
 
     return CHOOSING
 
 
 async def send_today_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    prompt_text = format_daily_prompt(update.effective_user.first_name)
-    conversation.add_content(
-        os.getenv("BOT_NAME"), prompt_text, is_bot=True, category="prompt"
+    chat_id = update.effective_message.chat_id
+    prompt_text = format_daily_prompt(
+        update.effective_user.first_name, context.chat_data
+    )
+    await journal.add_content(
+        chat_id, os.getenv("BOT_NAME"), prompt_text, is_bot=True, category="prompt"
     )
     await update.message.reply_text(
         prompt_text, parse_mode="Markdown", reply_markup=markup
@@ -232,42 +315,47 @@ async def send_today_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def received_information(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> int:
+    chat_id = update.effective_message.chat_id
     answer = update.message.text
-    conversation.add_content("me", answer)
+    await journal.add_content(chat_id, "me", answer)
 
     reply_text = "Got it 😊 Add anything else?"
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text, reply_markup=markup)
 
     return CHOOSING
 
 
 async def share_experience(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id = update.effective_message.chat_id
     reply_text = "How’s your day been?"
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text)
     return TYPING_REPLY
 
 
 async def share_thought(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id = update.effective_message.chat_id
     reply_text = "What’s on your mind?"
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text)
     return TYPING_REPLY
 
 
 async def share_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id = update.effective_message.chat_id
     context.user_data["expected_media_type"] = "photo"
     reply_text = "Send a photo."
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text)
     return MEDIA
 
 
 async def share_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id = update.effective_message.chat_id
     context.user_data["expected_media_type"] = "audio"
     reply_text = "Send an audio file or voice note."
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text)
     return MEDIA
 
@@ -278,6 +366,7 @@ def media_filter():
 
 async def receive_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     message = update.message
+    chat_id = message.chat_id
     media_file = None
     mimetype = None
     extension = None
@@ -321,39 +410,152 @@ async def receive_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await message.reply_text(reply_text, reply_markup=markup)
         return CHOOSING
 
-    file_bytes = bytes(await media_file.download_as_bytearray())
-    conversation.add_media(file_bytes, mimetype, extension=extension)
+    upload = media_uploader.submit(
+        chat_id, media_file, mimetype, extension=extension, caption=message.caption
+    )
+    if upload is None:
+        reply_text = (
+            f"I’m still saving your earlier uploads. Send this {media_label} "
+            "again in a moment."
+        )
+        await message.reply_text(reply_text, reply_markup=markup)
+        return CHOOSING
+
     context.user_data.pop("expected_media_type", None)
 
-    if message.caption:
-        conversation.add_content("me", message.caption, category="media_caption")
+    reply_text = f"Got your {media_label}, saving it now…"
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await message.reply_text(reply_text)
 
-    reply_text = f"Saved your {media_label}. Want to add a few words?"
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
-    await message.reply_text(reply_text, reply_markup=markup)
+    context.application.create_task(
+        confirm_media_saved(message, media_label, upload), update=update
+    )
     return CHOOSING
 
 
+async def confirm_media_saved(message, media_label, upload) -> None:
+    try:
+        file_name = await upload
+    except Exception:
+        logging.exception("Saving %s failed", media_label)
+        reply_text = f"Sorry, I couldn’t save your {media_label}. Please send it again."
+    else:
+        if file_name is None:
+            reply_text = (
+                f"Google Drive is slow right now, I’ll keep trying to save your "
+                f"{media_label}. Want to add a few words?"
+            )
+        else:
+            reply_text = f"Saved your {media_label}. Want to add a few words?"
+
+    await journal.add_content(
+        message.chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True
+    )
+    await message.reply_text(reply_text, reply_markup=markup)
+
+
 async def reflection_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    question = conversation.get_reflection_question()
-    conversation.add_content(
-        os.getenv("BOT_NAME"), question, category="reflection", is_bot=True
+    chat_id = update.effective_message.chat_id
+    question = conversation.get_reflection_question(
+        context.chat_data.setdefault("reflection_deck", {})
+    )
+    await journal.add_content(
+        chat_id, os.getenv("BOT_NAME"), question, category="reflection", is_bot=True
     )
 
     await update.message.reply_text(question)
     return TYPING_REPLY
 
 
-async def initiate_conversation(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job = context.job
-    hello = greeting()
-    await context.bot.send_message(job.chat_id, text=hello, reply_markup=markup)
+async def initiate_conversation(bot, chat_id: int, chat_data) -> None:
+    stats = await read_journal(
+        conversation.get_stats, chat_id, chat_now(chat_data).date()
+    )
+    today_entries = stats["today_entries"]
+    if today_entries:
+        # already journaled today, a light nudge instead of the full prompt
+        reply_text = (
+            f"You’ve written {today_entries} "
+            f"{'entry' if today_entries == 1 else 'entries'} today 🙌 "
+            "Anything else before the day ends?"
+        )
+        await journal.add_content(
+            chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True, category="prompt"
+        )
+        await broadcaster.send(
+            bot.send_message, chat_id, text=reply_text, reply_markup=markup
+        )
+        return
+
+    hello = greeting(chat_timezone(chat_data))
+    await broadcaster.send(bot.send_message, chat_id, text=hello, reply_markup=markup)
+
+    prompt_text = format_daily_prompt("there", chat_data)
+    await journal.add_content(
+        chat_id, os.getenv("BOT_NAME"), prompt_text, is_bot=True, category="prompt"
+    )
+    await broadcaster.send(
+        bot.send_message, chat_id, text=prompt_text, parse_mode="Markdown"
+    )
+
 
-    prompt_text = format_daily_prompt(first_name="there")
-    conversation.add_content(
-        os.getenv("BOT_NAME"), prompt_text, is_bot=True, category="prompt"
+def local_bucket_start(chat_data, bucket_start: datetime) -> datetime:
+    timezone_name = chat_timezone(chat_data)
+    return bucket_start.astimezone(
+        get_timezone(timezone_name) if timezone_name else None
     )
-    await context.bot.send_message(job.chat_id, text=prompt_text, parse_mode="Markdown")
+
+
+def prompt_due(chat_data, bucket_start: datetime) -> bool:
+    # due when the chat's local prompt time falls in this quarter hour and it
+    # has not been prompted yet on its local day
+    local_start = local_bucket_start(chat_data, bucket_start)
+    if chat_data.get("daily_prompt_last_sent") == local_start.date().isoformat():
+        return False
+
+    prompt_time = chat_prompt_time(chat_data)
+    minutes = prompt_time.hour * 60 + prompt_time.minute
+    start_minutes = local_start.hour * 60 + local_start.minute
+    return start_minutes <= minutes < start_minutes + PROMPT_BUCKET_MINUTES
+
+
+def current_bucket_start() -> datetime:
+    now = datetime.now(timezone.utc)
+    return now.replace(
+        minute=now.minute - now.minute % PROMPT_BUCKET_MINUTES,
+        second=0,
+        microsecond=0,
+    )
+
+
+async def dispatch_daily_prompts(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # runs every quarter hour and prompts the chats whose local prompt time
+    # falls in it, paced by the broadcaster
+    application = context.application
+    bucket_start = current_bucket_start()
+
+    async def deliver(chat_id):
+        chat_data = application.chat_data[chat_id]
+        # the bucket's day, not the delivery time: a late 23:45 prompt must
+        # not use up the next day's
+        chat_data["daily_prompt_last_sent"] = (
+            local_bucket_start(chat_data, bucket_start).date().isoformat()
+        )
+        application.mark_data_for_update_persistence(chat_ids=chat_id)
+        try:
+            await initiate_conversation(context.bot, chat_id, chat_data)
+        except Forbidden:
+            # the bot was blocked or removed, stop prompting this chat
+            chat_data["daily_prompt_enabled"] = False
+            raise
+
+    chat_ids = (
+        chat_id
+        for chat_id, chat_data in list(application.chat_data.items())
+        if chat_data.get("daily_prompt_enabled")
+        and prompt_due(chat_data, bucket_start)
+    )
+    await broadcaster.fan_out(chat_ids, deliver)
 
 
 async def enable_daily_prompt(
@@ -361,9 +563,8 @@ async def enable_daily_prompt(
 ) -> int:
     chat_id = update.effective_message.chat_id
     context.chat_data["daily_prompt_enabled"] = True
-    schedule_daily_prompt(chat_id, context)
-    reply_text = daily_prompt_status_text()
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    reply_text = daily_prompt_status_text(context.chat_data)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.effective_message.reply_text(reply_text, reply_markup=markup)
     return CHOOSING
 
@@ -372,50 +573,292 @@ async def disable_daily_prompt(
     update: Update, context: ContextTypes.DEFAULT_TYPE
 ) -> int:
     chat_id = update.effective_message.chat_id
-    remove_job_if_exists(daily_prompt_job_name(chat_id), context)
     context.chat_data["daily_prompt_enabled"] = False
 
     reply_text = "Daily journal prompts are off. Send /start or tap Enable Daily Prompt to turn them back on."
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.effective_message.reply_text(reply_text, reply_markup=markup)
     return CHOOSING
 
 
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_message.chat_id
+    if context.args:
+        timezone_name = parse_timezone(context.args[0])
+        if timezone_name is None:
+            reply_text = (
+                f"I don’t know the timezone {context.args[0]!r}. "
+                "Try something like /timezone Europe/Berlin."
+            )
+            await update.effective_message.reply_text(reply_text)
+            return
+        context.chat_data["timezone"] = timezone_name
+
+    reply_text = daily_prompt_status_text(context.chat_data)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await update.effective_message.reply_text(reply_text)
+
+
+async def set_prompt_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_message.chat_id
+    if context.args:
+        prompt_time = parse_prompt_time(context.args[0])
+        if prompt_time is None:
+            reply_text = "Send the time as HH:MM, for example /prompt_time 07:30."
+            await update.effective_message.reply_text(reply_text)
+            return
+        context.chat_data["daily_prompt_time"] = prompt_time.strftime("%H:%M")
+
+    reply_text = daily_prompt_status_text(context.chat_data)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await update.effective_message.reply_text(reply_text)
+
+
+def format_stats(stats) -> str:
+    def plural(count, word, words):
+        return f"{count} {word if count == 1 else words}"
+
+    lines = [
+        "📊 *Your journal*",
+        f"Today: {plural(stats['today_entries'], 'entry', 'entries')}",
+        f"Current streak: {plural(stats['current_streak'], 'day', 'days')}",
+        f"Longest streak: {plural(stats['longest_streak'], 'day', 'days')}",
+        f"All time: {plural(stats['entries'], 'entry', 'entries')}",
+    ]
+    if stats["today_by_category"]:
+        breakdown = ", ".join(
+            f"{category.replace('_', ' ')} {count}"
+            for category, count in stats["today_by_category"].most_common()
+        )
+        lines.append(f"Today by type: {breakdown}")
+    if stats["last_reflection_day"]:
+        lines.append(
+            f"Last reflection: {stats['last_reflection_day'].strftime('%b %-d, %Y')}"
+        )
+    return "\n".join(lines)
+
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_message.chat_id
+    stats = await read_journal(
+        conversation.get_stats, chat_id, chat_now(context.chat_data).date()
+    )
+    await update.effective_message.reply_text(
+        format_stats(stats), parse_mode="Markdown"
+    )
+
+
+DOC_URL = "https://docs.google.com/document/d/{}"
+
+
+def format_search_results(terms: str, results) -> str:
+    if not results:
+        return f"Nothing in your journal matches {html.escape(terms)!r}."
+
+    lines = []
+    for day, snippet, doc_id in results:
+        snippet = (
+            html.escape(snippet)
+            .replace(HIGHLIGHT[0], "<b>")
+            .replace(HIGHLIGHT[1], "</b>")
+        )
+        heading = day.strftime("%b %-d, %Y")
+        if doc_id:
+            heading = f'<a href="{DOC_URL.format(doc_id)}">{heading}</a>'
+        lines.append(f"{heading}\n{snippet}")
+    return "\n\n".join(lines)
+
+
+async def search_journal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_message.chat_id
+    terms = " ".join(context.args or [])
+    if not terms:
+        await update.effective_message.reply_text(
+            "Send what to look for, for example /search camping trip."
+        )
+        return
+
+    results = await read_journal(conversation.search, chat_id, terms)
+    await update.effective_message.reply_text(
+        format_search_results(terms, results),
+        parse_mode="HTML",
+        disable_web_page_preview=True,
+    )
+
+
+# bots can send documents of up to 50 MB
+MAX_EXPORT_BYTES = 50 * 1024 * 1024
+
+# /export names of the conversation categories; plain entries have none
+EXPORT_CATEGORIES = {
+    "journal": "",
+    "media": "media",
+    "media_caption": "media_caption",
+    "reflection": "reflection",
+    "prompt": "prompt",
+}
+EXPORT_USAGE = (
+    "Send /export [markdown|jsonl|zip] [start] [end] [category], for example "
+    "/export jsonl 2024-01-01 2024-06-30 reflection. Categories: {}.".format(
+        ", ".join(EXPORT_CATEGORIES)
+    )
+)
+
+
+def parse_export_args(args):
+    # /export [markdown|jsonl|zip] [start] [end] [category], in any order;
+    # None when an argument is none of these
+    export_format, days, category = "markdown", [], None
+    for arg in args:
+        if arg.lower() in export.FORMATS:
+            export_format = arg.lower()
+        elif arg.lower() in EXPORT_CATEGORIES:
+            category = EXPORT_CATEGORIES[arg.lower()]
+        else:
+            try:
+                days.append(date.fromisoformat(arg))
+            except ValueError:
+                return None
+    days.sort()
+    start = days[0] if days else None
+    end = days[-1] if len(days) > 1 else None
+    return export_format, start, end, category
+
+
+async def export_journal(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_message.chat_id
+    export_args = parse_export_args(context.args or [])
+    if export_args is None:
+        await update.effective_message.reply_text(EXPORT_USAGE)
+        return
+    export_format, start, end, category = export_args
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "journal-{}.{}".format(
+            (end or date.today()).isoformat(), export.EXTENSIONS[export_format]
+        )
+        path = os.path.join(directory, filename)
+        try:
+            await asyncio.to_thread(
+                export.export_to_path,
+                path,
+                export_format,
+                db_session,
+                drive=conversation.goog_drive,
+                max_bytes=MAX_EXPORT_BYTES,
+                start=start,
+                end=end,
+                chat_id=chat_id,
+                category=category,
+                timezone=conversation.day_resolver(chat_id).timezone,
+            )
+        except export.ExportTooLarge:
+            await update.effective_message.reply_text(
+                "That export is over Telegram’s 50 MB limit. Pick a shorter date "
+                "range, for example /export 2024-01-01 2024-06-30."
+            )
+            return
+
+        with open(path, "rb") as document:
+            await update.effective_message.reply_document(
+                document, filename=filename, write_timeout=120
+            )
+
+
+def format_perf(outbox_pending: int) -> str:
+    def millis(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.3g}ms"
+
+    def histogram_lines(histogram):
+        return [
+            f"  {'/'.join(labels)}: {count}x, mean {millis(mean)}, "
+            f"p50 ≤{millis(p50)}, p99 ≤{millis(p99)}"
+            for labels, (count, mean, p50, p99) in histogram.summary().items()
+        ]
+
+    lines = ["Stages"] + histogram_lines(metrics.STAGE_SECONDS)
+    lines.append("Google API calls")
+    errors = metrics.GOOGLE_ERRORS.values()
+    for (method,), count in sorted(metrics.GOOGLE_CALLS.values().items()):
+        failed = sum(n for labels, n in errors.items() if labels[0] == method)
+        lines.append(f"  {method}: {count} ({failed} failed)")
+    lines.append("Telegram requests")
+    lines.extend(histogram_lines(metrics.TELEGRAM_SEND_SECONDS))
+    lines.append(
+        f"Queues: journal {journal.depth}, uploads {media_uploader.in_flight}, "
+        f"outbox {outbox_pending}"
+    )
+    if loop_watchdog.enabled:
+        lines.append("Event loop stalls")
+        lines.extend(
+            f"  {handler}: {count}x, {millis(total)} total, longest {millis(longest)}"
+            for handler, (count, total, longest) in loop_watchdog.ranking()[:5]
+        )
+    return "\n".join(lines)
+
+
+async def show_perf(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    outbox_pending = await read_journal(outbox.pending)
+    await update.effective_message.reply_text(format_perf(outbox_pending))
+
+
 async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    chat_id = update.effective_message.chat_id
     user_data = context.user_data
     reply_text = "Thanks for sharing. Talk soon 👋"
-    conversation.add_content(os.getenv("BOT_NAME"), reply_text, is_bot=True)
+    await journal.add_content(chat_id, os.getenv("BOT_NAME"), reply_text, is_bot=True)
     await update.message.reply_text(reply_text, reply_markup=ReplyKeyboardRemove())
     user_data.clear()
     return ConversationHandler.END
 
 
-async def restore_daily_prompt_jobs(application) -> None:
-    for chat_id, chat_data in application.chat_data.items():
-        if not chat_data.get("daily_prompt_enabled"):
-            continue
+async def post_init(application) -> None:
+    loop_watchdog.start()
+    outbox.start()
+    journal.start()
+    schedule_daily_prompts(application)
 
-        application.job_queue.run_daily(
-            initiate_conversation,
-            time=configured_daily_prompt_time(),
-            chat_id=chat_id,
-            name=daily_prompt_job_name(chat_id),
-        )
+
+async def post_shutdown(application) -> None:
+    await media_uploader.stop()
+    await journal.stop()
+    await outbox.stop()
+    await media_spool.close()
+    await loop_watchdog.stop()
+
+
+def schedule_daily_prompts(application) -> None:
+    # one job per quarter hour, however many chats and timezones there are
+    bucket = timedelta(minutes=PROMPT_BUCKET_MINUTES)
+    application.job_queue.run_repeating(
+        dispatch_daily_prompts,
+        interval=bucket,
+        first=current_bucket_start() + bucket,
+        name=DAILY_PROMPT_JOB_NAME,
+    )
 
 
 # ----------------------- App Bootstrap -----------------------
 
 
-def main() -> None:
-    persistence = PicklePersistence(filepath="eva-journal-bot")
+def build_application(request=None):
+    # request replaces the HTTP transport to the bot API (benchmarks use a
+    # local stand-in)
+    persistence = SQLitePersistence()
 
-    application = (
+    builder = (
         ApplicationBuilder()
         .token(os.getenv("TELEGRAM_BOT_TOKEN"))
         .persistence(persistence)
-        .post_init(restore_daily_prompt_jobs)
-        .build()
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
     )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    else:
+        builder = builder.request(InstrumentedHTTPXRequest(connection_pool_size=256))
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[
@@ -462,8 +905,42 @@ def main() -> None:
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("daily_on", enable_daily_prompt))
     application.add_handler(CommandHandler("daily_off", disable_daily_prompt))
+    application.add_handler(CommandHandler("timezone", set_timezone))
+    application.add_handler(CommandHandler("prompt_time", set_prompt_time))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("search", search_journal))
+    application.add_handler(CommandHandler("export", export_journal))
+    application.add_handler(
+        CommandHandler("perf", show_perf, filters=filters.Chat(chat_id=ADMIN_CHAT_IDS))
+    )
+    return application
 
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+def main() -> None:
+    application = build_application()
+    if os.getenv("METRICS_PORT"):
+        metrics.start_http_server(int(os.getenv("METRICS_PORT")))
+
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        # telegram pushes updates to WEBHOOK_URL, proxied here by nginx
+        if not os.getenv("WEBHOOK_URL"):
+            sys.exit("BOT_MODE=webhook needs WEBHOOK_URL, the bot's public https URL")
+        url_path = os.getenv("WEBHOOK_PATH", "telegram")
+        asyncio.run(
+            run_webhook(
+                application,
+                listen=os.getenv("WEBHOOK_LISTEN", "0.0.0.0"),
+                port=int(os.getenv("WEBHOOK_PORT", "5000")),
+                url_path=url_path,
+                webhook_url="{}/{}".format(
+                    os.getenv("WEBHOOK_URL", "").rstrip("/"), url_path
+                ),
+                secret_token=os.getenv("WEBHOOK_SECRET_TOKEN")
+                or secrets.token_urlsafe(32),
+            )
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
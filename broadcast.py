@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+
+class TokenBucket(object):
+    # allows `rate` sends per second on average with bursts of up to `burst`
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def take(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        # telegram asked us to back off; hold every sender, not just one
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class Broadcaster(object):
+    # Fans messages out to many chats under Telegram's global limit of about
+    # 30 messages per second. Every send takes a token from a shared bucket,
+    # and a 429 pauses the whole bucket for the retry_after Telegram returns
+    # before the message is retried.
+
+    def __init__(self, rate=None, burst=None, concurrency=None, max_retries=None):
+        if rate is None:
+            rate = float(os.getenv("TELEGRAM_SEND_RATE", "25"))
+        if burst is None:
+            burst = int(os.getenv("TELEGRAM_SEND_BURST", str(int(rate))))
+        if concurrency is None:
+            concurrency = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "8"))
+        if max_retries is None:
+            max_retries = int(os.getenv("TELEGRAM_SEND_RETRIES", "5"))
+
+        self.bucket = TokenBucket(rate=max(rate, 0.1), burst=max(burst, 1))
+        self.concurrency = max(concurrency, 1)
+        self.max_retries = max_retries
+
+    async def send(self, func, *args, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.take()
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(
+                    "Telegram rate limit, pausing sends for %ss", e.retry_after
+                )
+                self.bucket.pause(_seconds(e.retry_after))
+            except TimedOut:
+                # the message may have gone out, do not send it twice
+                raise
+            except NetworkError:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2**attempt, 30)
+                logging.warning("Telegram send failed, retrying in %ds", delay)
+                await asyncio.sleep(delay)
+
+    async def fan_out(self, chat_ids, deliver):
+        # call deliver(chat_id) for every chat, a few at a time; chat_ids is
+        # consumed lazily so the backlog never grows past `concurrency`
+        chat_ids = iter(chat_ids)
+        counts = {"sent": 0, "failed": 0}
+        started = time.monotonic()
+
+        async def worker():
+            for chat_id in chat_ids:
+                try:
+                    await deliver(chat_id)
+                    counts["sent"] += 1
+                except Exception:
+                    counts["failed"] += 1
+                    logging.exception("Could not deliver to chat %s", chat_id)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        logging.info(
+            "Delivered to %d chats (%d failed) in %.1fs",
+            counts["sent"],
+            counts["failed"],
+            time.monotonic() - started,
+        )
+        return counts
+
+
+def _seconds(retry_after):
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
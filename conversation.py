@@ -1,16 +1,20 @@
+import json
 import os
-import random
-import tempfile
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from mimetypes import guess_extension
 
-import giphy_client
-import gspread
 import models
-import sqlalchemy
-from giphy_client.rest import ApiException as GiphyApiException
+from database import db_session, init_db
+from day_resolver import DayResolver
+from gif_pool import GifPool
 from google_drive import GoogleDrive
-from sqlalchemy import desc, orm
+from journal_search import JournalSearch
+from journal_stats import JournalStats
+from metrics import stage
+from reflection_deck import ReflectionDeck
+from sqlalchemy import desc, func
 
 
 class Conversation(object):
@@ -21,142 +25,284 @@ class Conversation(object):
         glphy_api_key="",
         training_data_file="./conversational-training-data.txt",
         reflection_question_data_file="reflection-questions.txt",
+        timezone=None,
+        max_cached_chats=None,
     ):
         self.training_data_file = training_data_file
         self.reflection_question_data_file = reflection_question_data_file
+        self.reflection_deck = ReflectionDeck(reflection_question_data_file)
 
         # load google drive instance
         self.goog_drive = GoogleDrive(service_account_file=service_account_file)
-        self.goog_sheet = gspread.service_account(filename=service_account_file)
         self.drive_folder_parent_id = drive_folder_parent_id
 
-        # open sqllite db
-        engine = sqlalchemy.create_engine("sqlite:///journal.sqlite")
-        self.db_session = orm.Session(bind=engine)
-        self.glphy_api = giphy_client.DefaultApi()
+        # open sqllite db; the scoped session hands each thread (journal
+        # writer, upload workers) its own session
+        init_db()
+        self.db_session = db_session
+        self.stats = JournalStats(db_session)
+        self.journal_search = JournalSearch(db_session)
+        self.timezone = timezone
+
+        # per-chat folder/doc resolvers, least recently used evicted first
+        if max_cached_chats is None:
+            max_cached_chats = int(os.getenv("MAX_CACHED_CHATS", "1024"))
+        self.max_cached_chats = max_cached_chats
+        self._day_resolvers = OrderedDict()
+        self._day_resolvers_lock = threading.Lock()
+        self._glphy_api = None
         self.glphy_api_key = glphy_api_key
-        self.GLIPHY_MAX_OFFSET = 0
-        self.GLIPHY_LIMIT = 100
+        self.gif_pool = GifPool(self._search_glphy)
+
+    @property
+    def glphy_api(self):
+        # giphy_client is slow to import and only needed with an api key
+        if self._glphy_api is None:
+            import giphy_client
+
+            self._glphy_api = giphy_client.DefaultApi()
+        return self._glphy_api
 
     def get_random_glphy(self, query):
+        # served from memory, see GifPool
         if not self.glphy_api_key:
             return ""
+        return self.gif_pool.pick(query)
 
-        random_limit = random.randint(0, self.GLIPHY_LIMIT)
-        random_offset = random.randint(0, self.GLIPHY_MAX_OFFSET)
+    def _search_glphy(self, query, limit):
+        response = self.glphy_api.gifs_search_get(
+            self.glphy_api_key, query, limit=limit
+        )
+        return [gif.images.fixed_height.url for gif in response.data]
+
+    def day_resolver(self, chat_id):
+        with self._day_resolvers_lock:
+            resolver = self._day_resolvers.get(chat_id)
+            if resolver is None:
+                resolver = DayResolver(
+                    chat_id,
+                    self.goog_drive,
+                    self.db_session,
+                    self.drive_folder_parent_id,
+                    self.timezone,
+                )
+                self._day_resolvers[chat_id] = resolver
+                if len(self._day_resolvers) > self.max_cached_chats:
+                    self._day_resolvers.popitem(last=False)
+            else:
+                self._day_resolvers.move_to_end(chat_id)
+
+            return resolver
+
+    def add_content(self, chat_id, speaker, message, category="", is_bot=False):
+        self.add_contents(
+            [
+                {
+                    "chat_id": chat_id,
+                    "speaker": speaker,
+                    "message": message,
+                    "category": category,
+                    "is_bot": is_bot,
+                }
+            ]
+        )
 
-        try:
-            response = self.glphy_api.gifs_search_get(
-                self.glphy_api_key, query, limit=random_limit, offset=random_offset
+    def add_contents(self, entries):
+        # entries are add_content keyword dicts. They are committed to sqlite
+        # together with an outbox row per entry; the outbox worker delivers
+        # them to google docs afterwards.
+        rows = []
+        stats = OrderedDict()
+        for entry in entries:
+            chat_id = entry["chat_id"]
+            if entry.get("is_bot"):
+                text_color = "37be83"
+                source = "bot"
+            else:
+                text_color = "4e79a7"
+                source = "human"
+
+            day_resolver = self.day_resolver(chat_id)
+            day = day_resolver.today()
+            category = entry.get("category", "")
+            stats.setdefault((chat_id, day), []).append(
+                (category, source)
             )
-        except GiphyApiException as e:
-            print("Exception when calling DefaultApi->gifs_search_get: %s\n" % e)
-            return ""
-
-        return response.data[0].images.fixed_height.url
 
-    def _get_folder(self):
-        folder_name = datetime.now().strftime("%b %y")
-        folder = (
-            self.db_session.query(models.Folder)
-            .filter(models.Folder.name == folder_name)
-            .first()
-        )
-
-        if not folder:
-            response = self.goog_drive.create_folder(
-                folder_name, self.drive_folder_parent_id
+            rows.append(
+                models.Conversation(
+                    source=source,
+                    category=category,
+                    message=entry["message"],
+                    chat_id=chat_id,
+                )
             )
-            folder = models.Folder(
-                name=response.get("name"), goog_id=response.get("id")
+            rows.append(
+                models.Outbox(
+                    chat_id=chat_id,
+                    kind="doc_entry",
+                    doc_key=day_resolver.doc_key(day),
+                    payload=json.dumps(
+                        {
+                            "body": "{}:\n{}".format(
+                                entry["speaker"], entry["message"]
+                            ),
+                            "rgb_hex": text_color,
+                        }
+                    ),
+                )
             )
-            self.db_session.add(folder)
-            self.db_session.commit()
 
-        return folder
-
-    def _get_day_doc(self, folder_parents_id):
-        doc_name = datetime.now().strftime("%b %-d conversation")
-        doc = (
-            self.db_session.query(models.Doc)
-            .filter(models.Doc.name == doc_name)
-            .first()
-        )
-        if not doc:
-            response = self.goog_drive.create_document(
-                doc_name, folder_parents_id=folder_parents_id
-            )
-            doc = models.Doc(name=response.get("name"), goog_id=response.get("id"))
-            self.db_session.add(doc)
+        # save conversation to sqllite, with the stats counters in the same
+        # transaction
+        self.db_session.add_all(rows)
+        with stage("sqlite_commit"):
+            for (chat_id, day), chat_entries in stats.items():
+                self.stats.record(chat_id, day, chat_entries)
             self.db_session.commit()
 
-        return doc
-
-    def add_content(self, speaker, message, category="", is_bot=False):
-        folder = self._get_folder()
+    def get_stats(self, chat_id, today=None):
+        # today is the chat's own day when it has a /timezone of its own
+        if today is None:
+            today = self.day_resolver(chat_id).today()
+        return self.stats.summary(chat_id, today)
 
-        # save message to google docs
-        doc = self._get_day_doc(folder_parents_id=folder.goog_id)
-
-        if is_bot:
-            text_color = "37be83"
-            source = "bot"
-        else:
-            text_color = "4e79a7"
-            source = "human"
-
-        self.goog_drive.write_document(
-            document_id=doc.goog_id,
-            body="{}:\n{}".format(speaker, message),
-            rgb_hex=text_color,
+    def search(self, chat_id, terms, limit=5):
+        return self.journal_search.search(
+            chat_id, terms, timezone=self.day_resolver(chat_id).timezone, limit=limit
         )
 
-        # save conversation to sqllite
-        conversation = models.Conversation(
-            source=source, category=category, message=message
+    def add_media(self, chat_id, file_path, mimetype, extension=None):
+        file_name, response = self.upload_media(
+            chat_id, file_path, mimetype, extension=extension
         )
-        self.db_session.add(conversation)
-        self.db_session.commit()
-
-    def add_media(self, file_bytes, mimetype, extension=None):
-        folder = self._get_folder()
-
-        media_directory = "./media"
-        os.makedirs(media_directory, exist_ok=True)
+        self.record_media(chat_id, file_name, response.get("id"), mimetype)
 
+    def media_file_name(self, mimetype, extension=None):
         if not extension:
             guessed_extension = guess_extension(mimetype, strict=False) or ""
             extension = guessed_extension.lstrip(".") or mimetype.split("/")[-1]
 
-        file_name = "{}.{}".format(
+        return "{}.{}".format(
             datetime.now().strftime("%b-%-d-%Y-%-I-%M-%S-%p"), extension
         )
 
-        with tempfile.NamedTemporaryFile(
-            dir=media_directory, suffix=f".{extension}", delete=False
-        ) as temp_file:
-            temp_file.write(file_bytes)
-            full_file_path = temp_file.name
-
-        try:
-            os.replace(full_file_path, os.path.join(media_directory, file_name))
-            full_file_path = os.path.join(media_directory, file_name)
-            response = self.goog_drive.upload_media(
-                full_file_path, mimetype, folder.goog_id
-            )
-        finally:
-            if os.path.exists(full_file_path):
-                os.remove(full_file_path)
+    def upload_media(
+        self,
+        chat_id,
+        file_path,
+        mimetype,
+        extension=None,
+        file_name=None,
+        day=None,
+        remove_file=True,
+    ):
+        # file_path is a spooled download; it is uploaded in chunks and, unless
+        # remove_file is False, removed once Drive has it. Only talks to Drive,
+        # so it is safe to run on the upload workers.
+        folder_id = self.day_resolver(chat_id).folder_id(day)
+        file_name = file_name or self.media_file_name(mimetype, extension)
+
+        response = self.goog_drive.upload_media(
+            file_path, mimetype, folder_id, name=file_name
+        )
+        if remove_file:
+            os.remove(file_path)
 
-        media_type = mimetype.split("/")[0]
-        self.add_content(
-            "me", f"Uploaded {media_type}: {file_name}", category="media"
+        return file_name, response
+
+    def defer_media(
+        self,
+        chat_id,
+        file_path,
+        mimetype,
+        extension=None,
+        file_unique_id=None,
+        content_hash=None,
+        caption=None,
+    ):
+        # keep the spooled file and let the outbox worker retry the upload
+        resolver = self.day_resolver(chat_id)
+        outbox = models.Outbox(
+            chat_id=chat_id,
+            kind="media",
+            doc_key=resolver.doc_key(),
+            payload=json.dumps(
+                {
+                    "path": file_path,
+                    "mimetype": mimetype,
+                    "file_name": self.media_file_name(mimetype, extension),
+                    "file_unique_id": file_unique_id,
+                    "content_hash": content_hash,
+                    "caption": caption,
+                }
+            ),
         )
+        self.db_session.add(outbox)
+        with stage("sqlite_commit"):
+            self.db_session.commit()
+
+    def find_media(self, chat_id, file_unique_id=None, content_hash=None):
+        # (name, goog_id) of media this chat already saved, matched by
+        # telegram's file_unique_id or by the sha256 of its content
+        if file_unique_id:
+            condition = models.Media.file_unique_id == file_unique_id
+        elif content_hash:
+            condition = models.Media.content_hash == content_hash
+        else:
+            return None
+
+        return (
+            self.db_session.query(models.Media.name, models.Media.goog_id)
+            .filter(models.Media.chat_id == chat_id, condition)
+            .first()
+        )
+
+    def record_media(
+        self,
+        chat_id,
+        file_name,
+        goog_id,
+        mimetype,
+        file_unique_id=None,
+        content_hash=None,
+        duplicate=False,
+        caption=None,
+    ):
+        media_type = mimetype.split("/")[0]
+        entries = [
+            {
+                "chat_id": chat_id,
+                "speaker": "me",
+                "message": f"Uploaded {media_type}: {file_name}",
+                "category": "media",
+            }
+        ]
+        if duplicate:
+            # the drive file already exists, only the journal entry is new
+            entries[0]["message"] += " (already saved)"
+        else:
+            # add media  to sqllite
+            self.db_session.add(
+                models.Media(
+                    name=file_name,
+                    goog_id=goog_id,
+                    chat_id=chat_id,
+                    file_unique_id=file_unique_id,
+                    content_hash=content_hash,
+                )
+            )
 
-        # add media  to sqllite
-        media = models.Media(name=file_name, goog_id=response.get("id"))
-        self.db_session.add(media)
-        self.db_session.commit()
+        if caption:
+            entries.append(
+                {
+                    "chat_id": chat_id,
+                    "speaker": "me",
+                    "message": caption,
+                    "category": "media_caption",
+                }
+            )
+        self.add_contents(entries)
 
     def add_content_to_tranining_data(self, speaker, message):
         with open(self.training_data_file, "a+") as myfile:
@@ -167,58 +313,42 @@ class Conversation(object):
             all_of_it = myfile.read()
         return all_of_it
 
-    def total_messages(self, category=""):
-        conversations = (
-            self.db_session.query(models.Conversation)
+    def total_messages(self, chat_id, category=""):
+        return (
+            self.db_session.query(func.count())
+            .select_from(models.Conversation)
             .filter(
-                models.Conversation.source == "human",
+                models.Conversation.chat_id == chat_id,
                 models.Conversation.category == category,
+                models.Conversation.source == "human",
             )
-            .all()
+            .scalar()
         )
-        if conversations:
-            return len(conversations)
 
-        return 0
+    def has_journaled_today(self, chat_id):
+        return self.day_resolver(chat_id).has_doc_for_today()
 
-    def has_journaled_today(self):
-        doc_name = datetime.now().strftime("%b %-d conversation")
-        doc = (
-            self.db_session.query(models.Doc)
-            .filter(models.Doc.name == doc_name)
-            .first()
+    def has_reflected_today(self, chat_id):
+        # kept by JournalStats on the chat's TIMEZONE day, like today()
+        last_reflection_day = (
+            self.db_session.query(models.ChatStat.last_reflection_day)
+            .filter(models.ChatStat.chat_id == chat_id)
+            .scalar()
         )
-        if doc:
-            return True
-
-        return False
-
-    def has_reflected_today(self):
-        doc_name = datetime.now().strftime("%b %-d conversation")
-        conversation = (
-            self.db_session.query(models.Conversation)
-            .filter(models.Conversation.category == "reflection")
-            .order_by(desc("date"))
-            .first()
-        )
-        if conversation:
-            if conversation.date.date() == datetime.now().date():
-                return True
-
-        return False
+        return last_reflection_day == self.day_resolver(chat_id).today().isoformat()
 
-    def latest_message(self):
+    def latest_message(self, chat_id):
         conversation = (
             self.db_session.query(models.Conversation)
-            .filter()
-            .order_by(desc("date"))
+            .filter(models.Conversation.chat_id == chat_id)
+            .order_by(desc(models.Conversation.date))
             .first()
         )
         return conversation
 
-    def get_reflection_question(self):
-        # get total number of questions
-        with open(self.reflection_question_data_file, "r") as fp:
-            questions = fp.read().split("\n")
-            random_question = random.randint(0, len(questions) - 1)
-            return questions[random_question].strip()
+    def get_reflection_question(self, state=None, category=None):
+        # state holds the chat's place in the shuffled deck; without one the
+        # question is drawn from a fresh shuffle
+        if state is None:
+            state = {}
+        return self.reflection_deck.draw(state, category=category)
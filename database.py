@@ -1,13 +1,36 @@
 import os
+from collections import Counter
+from datetime import date, datetime, timedelta
 
 from dotenv import find_dotenv, load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 
 load_dotenv(find_dotenv())
 
-engine = create_engine("sqlite:///journal.sqlite")
+# one engine for the whole process. Connections are pooled and shared across
+# the writer, outbox and upload threads (one thread at a time per connection).
+engine = create_engine(
+    "sqlite:///journal.sqlite",
+    poolclass=QueuePool,
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    connect_args={"check_same_thread": False},
+)
+
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers run while the writer commits; NORMAL sync is durable
+    # across application crashes and much cheaper than FULL under WAL
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(
+        "PRAGMA busy_timeout={}".format(int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000")))
+    )
+    cursor.close()
 
 
 db_session = scoped_session(
@@ -25,3 +48,239 @@ def init_db():
     import models
 
     Base.metadata.create_all(bind=engine)
+    migrate_db()
+
+
+# ----------------------- Migrations -----------------------
+# Each migration upgrades an existing journal.sqlite by one version and must
+# be safe to run against a database freshly created by create_all. The
+# applied version is tracked in SQLite's user_version pragma. New tables need
+# no migration, create_all adds them (virtual tables excepted).
+
+
+def _table_columns(connection, table):
+    return {row[1] for row in connection.execute("PRAGMA table_info({})".format(table))}
+
+
+def _add_column(connection, table, column, ddl):
+    if column not in _table_columns(connection, table):
+        connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, ddl))
+
+
+def _add_folder_and_doc_keys(connection):
+    _add_column(connection, "folder", "key", "VARCHAR(20)")
+    _add_column(connection, "doc", "key", "VARCHAR(20)")
+
+    # year-qualify existing rows; if a day was created twice keep the oldest
+    connection.execute(
+        "UPDATE folder SET key = strftime('%Y-%m', date) WHERE id IN "
+        "(SELECT MIN(id) FROM folder WHERE key IS NULL "
+        "GROUP BY strftime('%Y-%m', date))"
+    )
+    connection.execute(
+        "UPDATE doc SET key = strftime('%Y-%m-%d', date) WHERE id IN "
+        "(SELECT MIN(id) FROM doc WHERE key IS NULL "
+        "GROUP BY strftime('%Y-%m-%d', date))"
+    )
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_folder_key ON folder (key)")
+    connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_doc_key ON doc (key)")
+
+
+def _partition_by_chat(connection):
+    for table in ("folder", "doc", "media", "conversation"):
+        _add_column(connection, table, "chat_id", "BIGINT")
+
+    # history from before per-chat journals belongs to LEGACY_CHAT_ID, whose
+    # month folders already live directly under the drive parent folder
+    legacy_chat_id = os.getenv("LEGACY_CHAT_ID")
+    drive_folder_parent_id = os.getenv("GOOGLE_DRIVE_PARENT_FOLDER_ID")
+    if legacy_chat_id:
+        for table in ("folder", "doc", "media", "conversation"):
+            connection.execute(
+                "UPDATE {} SET chat_id = ? WHERE chat_id IS NULL".format(table),
+                (int(legacy_chat_id),),
+            )
+        if drive_folder_parent_id:
+            connection.execute(
+                "INSERT OR IGNORE INTO chat (chat_id, goog_id, date) VALUES (?, ?, ?)",
+                (int(legacy_chat_id), drive_folder_parent_id, datetime.now()),
+            )
+
+    connection.execute("DROP INDEX IF EXISTS ix_folder_key")
+    connection.execute("DROP INDEX IF EXISTS ix_doc_key")
+    connection.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_folder_chat_id_key "
+        "ON folder (chat_id, key)"
+    )
+    connection.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_doc_chat_id_key ON doc (chat_id, key)"
+    )
+
+
+def _add_media_fingerprints(connection):
+    _add_column(connection, "media", "file_unique_id", "VARCHAR(64)")
+    _add_column(connection, "media", "content_hash", "VARCHAR(64)")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_media_chat_id_file_unique_id "
+        "ON media (chat_id, file_unique_id)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_media_chat_id_content_hash "
+        "ON media (chat_id, content_hash)"
+    )
+
+
+def _add_query_indexes(connection):
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_conversation_chat_id_date "
+        "ON conversation (chat_id, date)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_conversation_chat_id_category_source_date "
+        "ON conversation (chat_id, category, source, date)"
+    )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_outbox_status_next_attempt_at "
+        "ON outbox (status, next_attempt_at)"
+    )
+
+
+def _backfill_stats(connection):
+    # seed the incremental stats tables from existing history. Live updates
+    # count an entry on its day in TIMEZONE (DayResolver.today), while
+    # conversation dates are naive server local time, so history is counted
+    # per minute in SQL (every UTC offset is whole minutes) and moved to its
+    # TIMEZONE day here
+    from day_resolver import load_timezone
+
+    timezone = load_timezone(os.getenv("TIMEZONE"))
+    counts = Counter()
+    for chat_id, minute, category, source, count in connection.execute(
+        "SELECT chat_id, strftime('%Y-%m-%d %H:%M', date), COALESCE(category, ''), "
+        "source, COUNT(*) FROM conversation "
+        "WHERE chat_id IS NOT NULL AND date IS NOT NULL "
+        "GROUP BY chat_id, strftime('%Y-%m-%d %H:%M', date), category, source"
+    ):
+        day = datetime.fromisoformat(minute).astimezone(timezone).date()
+        counts[(chat_id, day.isoformat(), category, source)] += count
+
+    if counts:
+        connection.execute(
+            "INSERT OR IGNORE INTO daily_stat "
+            "(chat_id, day, category, source, count) VALUES (?, ?, ?, ?, ?)",
+            [key + (count,) for key, count in counts.items()],
+        )
+
+    chats = {}
+    for chat_id, day, category, count in connection.execute(
+        "SELECT chat_id, day, category, SUM(count) FROM daily_stat "
+        "WHERE source = 'human' GROUP BY chat_id, day, category ORDER BY chat_id, day"
+    ):
+        chat = chats.setdefault(
+            chat_id, {"entries": 0, "current": 0, "longest": 0, "last_day": None}
+        )
+        chat["entries"] += count
+        day = date.fromisoformat(day)
+        if chat["last_day"] != day:
+            if chat["last_day"] == day - timedelta(days=1):
+                chat["current"] += 1
+            else:
+                chat["current"] = 1
+            chat["longest"] = max(chat["longest"], chat["current"])
+            chat["last_day"] = day
+
+    last_reflections = dict(
+        connection.execute(
+            "SELECT chat_id, MAX(day) FROM daily_stat "
+            "WHERE category = 'reflection' GROUP BY chat_id"
+        ).fetchall()
+    )
+    for chat_id in set(chats) | set(last_reflections):
+        chat = chats.get(
+            chat_id, {"entries": 0, "current": 0, "longest": 0, "last_day": None}
+        )
+        connection.execute(
+            "INSERT OR IGNORE INTO chat_stat (chat_id, entries, current_streak, "
+            "longest_streak, last_entry_day, last_reflection_day) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                chat_id,
+                chat["entries"],
+                chat["current"],
+                chat["longest"],
+                chat["last_day"].isoformat() if chat["last_day"] else None,
+                last_reflections.get(chat_id),
+            ),
+        )
+
+
+def _import_pickle_persistence(connection):
+    # carry bot state over from the PicklePersistence file used before
+    # SQLitePersistence; the file is left in place and can be deleted
+    from persistence import pickle_file_rows
+
+    filepath = os.getenv("PERSISTENCE_PICKLE_FILE", "eva-journal-bot")
+    if not os.path.exists(filepath):
+        return
+
+    now = datetime.now()
+    for kind, key, value in pickle_file_rows(filepath):
+        connection.execute(
+            "INSERT OR IGNORE INTO bot_state (kind, key, value, date) "
+            "VALUES (?, ?, ?, ?)",
+            (kind, key, value, now),
+        )
+
+
+def _add_full_text_search(connection):
+    # create_all does not know about virtual tables, so the FTS5 index over
+    # conversation.message lives here. It stores no copy of the text, the
+    # triggers keep it in step with the table and 'rebuild' indexes history.
+    connection.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5("
+        "message, content='conversation', content_rowid='id', "
+        "tokenize='porter unicode61 remove_diacritics 2')"
+    )
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS conversation_fts_insert "
+        "AFTER INSERT ON conversation BEGIN "
+        "INSERT INTO conversation_fts (rowid, message) VALUES (new.id, new.message); "
+        "END"
+    )
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS conversation_fts_delete "
+        "AFTER DELETE ON conversation BEGIN "
+        "INSERT INTO conversation_fts (conversation_fts, rowid, message) "
+        "VALUES ('delete', old.id, old.message); "
+        "END"
+    )
+    connection.execute(
+        "CREATE TRIGGER IF NOT EXISTS conversation_fts_update "
+        "AFTER UPDATE OF message ON conversation BEGIN "
+        "INSERT INTO conversation_fts (conversation_fts, rowid, message) "
+        "VALUES ('delete', old.id, old.message); "
+        "INSERT INTO conversation_fts (rowid, message) VALUES (new.id, new.message); "
+        "END"
+    )
+    connection.execute(
+        "INSERT INTO conversation_fts (conversation_fts) VALUES ('rebuild')"
+    )
+
+
+MIGRATIONS = [
+    _add_folder_and_doc_keys,
+    _partition_by_chat,
+    _add_media_fingerprints,
+    _add_query_indexes,
+    _backfill_stats,
+    _import_pickle_persistence,
+    _add_full_text_search,
+]
+
+
+def migrate_db():
+    with engine.begin() as connection:
+        version = connection.execute("PRAGMA user_version").scalar()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(connection)
+            connection.execute("PRAGMA user_version = {}".format(number))
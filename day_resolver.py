@@ -0,0 +1,174 @@
+import logging
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import models
+from metrics import stage
+from sqlalchemy.exc import IntegrityError
+
+
+class DayResolver(object):
+    # Keeps one chat's current month Drive folder and today's Doc goog_ids in
+    # memory. Rows are keyed by year-qualified dates ("2024-05",
+    # "2024-05-17") in the configured timezone, and creation is serialized so
+    # concurrent writers at midnight still produce a single folder/doc.
+
+    def __init__(
+        self, chat_id, goog_drive, db_session, drive_folder_parent_id, timezone=None
+    ):
+        self.chat_id = chat_id
+        self.goog_drive = goog_drive
+        self.db_session = db_session
+        self.drive_folder_parent_id = drive_folder_parent_id
+        self.timezone = load_timezone(timezone)
+
+        self._lock = threading.Lock()
+        self._folder = (None, None)
+        self._doc = (None, None)
+
+    def today(self):
+        return datetime.now(self.timezone).date()
+
+    def folder_key(self, day=None):
+        return (day or self.today()).strftime("%Y-%m")
+
+    def doc_key(self, day=None):
+        return (day or self.today()).strftime("%Y-%m-%d")
+
+    def folder_id(self, day=None):
+        # only today's ids are cached; older days (late outbox deliveries)
+        # are looked up in the database
+        day = day or self.today()
+        cached_key, goog_id = self._folder
+        if cached_key == self.folder_key(day):
+            return goog_id
+
+        with self._lock, stage("folder_resolve"):
+            return self._resolve_folder(day)
+
+    def doc_id(self, day=None):
+        day = day or self.today()
+        cached_key, goog_id = self._doc
+        if cached_key == self.doc_key(day):
+            return goog_id
+
+        with self._lock:
+            with stage("folder_resolve"):
+                folder_id = self._resolve_folder(day)
+            with stage("doc_resolve"):
+                return self._resolve_doc(day, folder_id)
+
+    def has_doc_for_today(self):
+        key = self.doc_key()
+        if self._doc[0] == key:
+            return True
+
+        return (
+            self.db_session.query(models.Doc.id)
+            .filter(models.Doc.chat_id == self.chat_id, models.Doc.key == key)
+            .first()
+            is not None
+        )
+
+    def _chat_folder_id(self):
+        # every chat gets its own parent folder under the drive root
+        chat = (
+            self.db_session.query(models.Chat)
+            .filter(models.Chat.chat_id == self.chat_id)
+            .first()
+        )
+        if chat:
+            return chat.goog_id
+
+        response = self.goog_drive.create_folder(
+            "chat {}".format(self.chat_id), self.drive_folder_parent_id
+        )
+        chat = models.Chat(chat_id=self.chat_id, goog_id=response.get("id"))
+        self.db_session.add(chat)
+        try:
+            self.db_session.commit()
+        except IntegrityError:
+            self.db_session.rollback()
+            chat = (
+                self.db_session.query(models.Chat)
+                .filter(models.Chat.chat_id == self.chat_id)
+                .one()
+            )
+
+        return chat.goog_id
+
+    def _resolve_folder(self, day):
+        key = self.folder_key(day)
+        if self._folder[0] == key:
+            return self._folder[1]
+
+        goog_id = self._get_or_create(
+            models.Folder,
+            key,
+            lambda: self.goog_drive.create_folder(
+                day.strftime("%b %y"), self._chat_folder_id()
+            ),
+        )
+        if key == self.folder_key():
+            self._folder = (key, goog_id)
+        return goog_id
+
+    def _resolve_doc(self, day, folder_id):
+        key = self.doc_key(day)
+        if self._doc[0] == key:
+            return self._doc[1]
+
+        goog_id = self._get_or_create(
+            models.Doc,
+            key,
+            lambda: self.goog_drive.create_document(
+                day.strftime("%b %-d conversation"), folder_parents_id=folder_id
+            ),
+        )
+        if key == self.doc_key():
+            self._doc = (key, goog_id)
+        return goog_id
+
+    def _get_or_create(self, model, key, create):
+        query = self.db_session.query(model).filter(
+            model.chat_id == self.chat_id, model.key == key
+        )
+        row = query.first()
+        if row:
+            return row.goog_id
+
+        response = create()
+        row = model(
+            name=response.get("name"),
+            goog_id=response.get("id"),
+            key=key,
+            chat_id=self.chat_id,
+        )
+        self.db_session.add(row)
+        try:
+            self.db_session.commit()
+        except IntegrityError:
+            # another process created the same day first, use its row
+            self.db_session.rollback()
+            logging.warning(
+                "Duplicate %s for %s created, keeping the first",
+                model.__tablename__,
+                key,
+            )
+            row = query.one()
+
+        return row.goog_id
+
+
+def load_timezone(timezone):
+    if not timezone:
+        return None
+
+    try:
+        return ZoneInfo(timezone)
+    except Exception:
+        logging.warning(
+            "Invalid TIMEZONE %r. Falling back to server local time.", timezone
+        )
+        return None
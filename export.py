@@ -0,0 +1,296 @@
+"""Export journal history to Markdown, JSONL or a zip with the media files.
+
+    python export.py --format markdown --start 2024-01-01 --end 2024-12-31 \\
+        --chat 12345 --output journal-2024.md
+
+Rows are read in batches from server-side cursors and written out as they
+arrive, so memory use does not depend on how much history is exported. The
+zip holds journal.md plus every media file, streamed from Google Drive
+(needs SERVICE_ACCOUNT_FILE). Days and times are in TIMEZONE, like the day
+docs and /stats.
+"""
+import argparse
+import heapq
+import json
+import logging
+import os
+import sys
+import zipfile
+from datetime import date, datetime, time, timedelta
+
+import models
+
+FORMATS = ("markdown", "jsonl", "zip")
+EXTENSIONS = {"markdown": "md", "jsonl": "jsonl", "zip": "zip"}
+BATCH_SIZE = 500
+DRIVE_FILE_URL = "https://drive.google.com/file/d/{}/view"
+
+
+class ExportTooLarge(Exception):
+    pass
+
+
+def iter_entries(
+    db_session, start=None, end=None, chat_id=None, category=None, timezone=None
+):
+    columns = models.Conversation
+    query = db_session.query(
+        columns.id,
+        columns.chat_id,
+        columns.date,
+        columns.source,
+        columns.category,
+        columns.message,
+    )
+    query = _filter(query, columns, start, end, chat_id, timezone)
+    if category is not None:
+        query = query.filter(columns.category == category)
+    query = query.order_by(columns.chat_id, columns.date, columns.id)
+
+    for row in query.execution_options(stream_results=True).yield_per(BATCH_SIZE):
+        yield {
+            "type": "entry",
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "date": _journal_time(row.date, timezone),
+            "source": row.source,
+            "category": row.category or "",
+            "message": row.message,
+        }
+
+
+def iter_media(db_session, start=None, end=None, chat_id=None, timezone=None):
+    columns = models.Media
+    query = db_session.query(
+        columns.id, columns.chat_id, columns.date, columns.name, columns.goog_id
+    )
+    query = _filter(query, columns, start, end, chat_id, timezone)
+    query = query.order_by(columns.chat_id, columns.date, columns.id)
+
+    for row in query.execution_options(stream_results=True).yield_per(BATCH_SIZE):
+        yield {
+            "type": "media",
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "date": _journal_time(row.date, timezone),
+            "name": row.name,
+            "goog_id": row.goog_id,
+        }
+
+
+def iter_records(
+    db_session, start=None, end=None, chat_id=None, category=None, timezone=None
+):
+    # entries and media interleaved by chat and time; media has no category
+    # of its own and goes with the "media" entries
+    streams = [iter_entries(db_session, start, end, chat_id, category, timezone)]
+    if category in (None, "media"):
+        streams.append(iter_media(db_session, start, end, chat_id, timezone))
+    return heapq.merge(*streams, key=_record_order)
+
+
+def markdown_lines(records, media_link=None):
+    if media_link is None:
+        media_link = _drive_link
+
+    chat_id = day = None
+    yield "# Journal\n"
+    for number, record in enumerate(records):
+        if not number or record["chat_id"] != chat_id:
+            chat_id, day = record["chat_id"], None
+            yield "\n## Chat {}\n".format(chat_id)
+        if record["date"].date() != day:
+            day = record["date"].date()
+            yield "\n### {}\n".format(day.strftime("%a, %b %-d %Y"))
+
+        at = record["date"].strftime("%H:%M")
+        if record["type"] == "media":
+            yield "\n- {} [{}]({})\n".format(at, record["name"], media_link(record))
+            continue
+
+        speaker = "Me" if record["source"] == "human" else "Bot"
+        details = " · ".join(filter(None, [at, record["category"].replace("_", " ")]))
+        yield "\n**{}** · {}\n\n{}\n".format(speaker, details, record["message"])
+
+
+def jsonl_lines(records):
+    for record in records:
+        record = dict(record, date=record["date"].isoformat())
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def export(fp, export_format, db_session, drive=None, max_bytes=None, **filters):
+    # writes to the binary file fp; filters are start, end (dates, inclusive),
+    # chat_id, category and the timezone days are counted in. Raises
+    # ExportTooLarge as soon as more than max_bytes have been written, before
+    # fetching the rest of the media.
+    budget = _Budget(fp, max_bytes)
+    if export_format == "markdown":
+        _write_lines(fp, markdown_lines(iter_records(db_session, **filters)), budget)
+    elif export_format == "jsonl":
+        _write_lines(fp, jsonl_lines(iter_records(db_session, **filters)), budget)
+    elif export_format == "zip":
+        _write_zip(fp, db_session, drive, budget, **filters)
+    else:
+        raise ValueError("Unknown export format {!r}".format(export_format))
+    # the zip directory and compressor buffers are only written at the end
+    budget.check()
+
+
+def export_to_path(path, export_format, db_session, drive=None, **options):
+    try:
+        with open(path, "wb") as fp:
+            export(fp, export_format, db_session, drive=drive, **options)
+    finally:
+        # runs on worker threads too, so hand back that thread's session
+        db_session.remove()
+
+
+class _Budget(object):
+    # checks the size of the output file, which needs a seekable fp
+    def __init__(self, fp, max_bytes):
+        self.fp = fp
+        self.max_bytes = max_bytes
+
+    def check(self):
+        if self.max_bytes is not None and self.fp.tell() > self.max_bytes:
+            raise ExportTooLarge(
+                "Export is larger than {} bytes".format(self.max_bytes)
+            )
+
+
+class _BudgetedWriter(object):
+    # a zip member that checks the budget after every chunk of a download
+    def __init__(self, member, budget):
+        self.member = member
+        self.budget = budget
+
+    def write(self, data):
+        written = self.member.write(data)
+        self.budget.check()
+        return written
+
+
+def _write_lines(fp, lines, budget):
+    for line in lines:
+        fp.write(line.encode("utf-8"))
+        budget.check()
+
+
+def _write_zip(fp, db_session, drive, budget, **filters):
+    media_link = _zip_media_path if drive is not None else _drive_link
+
+    with zipfile.ZipFile(fp, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("journal.md", "w", force_zip64=True) as member:
+            _write_lines(
+                member,
+                markdown_lines(iter_records(db_session, **filters), media_link),
+                budget,
+            )
+
+        if drive is None or filters.get("category") not in (None, "media"):
+            return
+
+        media_filters = {
+            key: value for key, value in filters.items() if key != "category"
+        }
+        for record in iter_media(db_session, **media_filters):
+            # photos and audio are already compressed
+            info = zipfile.ZipInfo(
+                _zip_media_path(record), record["date"].timetuple()[:6]
+            )
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, "w", force_zip64=True) as member:
+                try:
+                    drive.download_media(
+                        record["goog_id"], _BudgetedWriter(member, budget)
+                    )
+                except ExportTooLarge:
+                    raise
+                except Exception:
+                    logging.exception(
+                        "Could not download %s (%s)", record["name"], record["goog_id"]
+                    )
+
+
+def _filter(query, model, start, end, chat_id, timezone=None):
+    if start is not None:
+        query = query.filter(model.date >= _day_start(start, timezone))
+    if end is not None:
+        query = query.filter(model.date < _day_start(end + timedelta(days=1), timezone))
+    if chat_id is not None:
+        query = query.filter(model.chat_id == chat_id)
+    return query
+
+
+def _day_start(day, timezone):
+    # midnight in the journal's timezone as naive server local time, which
+    # is how conversation and media dates are stored
+    midnight = datetime.combine(day, time.min)
+    if timezone is None:
+        return midnight
+    return midnight.replace(tzinfo=timezone).astimezone().replace(tzinfo=None)
+
+
+def _journal_time(value, timezone):
+    # a stored date as naive time in the journal's timezone
+    if value is None or timezone is None:
+        return value
+    return value.astimezone(timezone).replace(tzinfo=None)
+
+
+def _record_order(record):
+    # same order as the queries: chat (NULL first), then time
+    chat_id = record["chat_id"]
+    return (chat_id is not None, chat_id or 0, record["date"] or datetime.min)
+
+
+def _drive_link(record):
+    return DRIVE_FILE_URL.format(record["goog_id"])
+
+
+def _zip_media_path(record):
+    return "media/{}-{}".format(record["id"], record["name"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--format", choices=FORMATS, default="markdown")
+    parser.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    parser.add_argument("--chat", type=int, help="only this chat id")
+    parser.add_argument("--category", help="only entries of this category")
+    parser.add_argument(
+        "--output",
+        help="file to write, - for stdout (default journal-export.<format>)",
+    )
+    args = parser.parse_args()
+
+    from database import db_session, init_db
+    from day_resolver import load_timezone
+
+    init_db()
+    filters = {
+        "start": args.start,
+        "end": args.end,
+        "chat_id": args.chat,
+        "category": args.category,
+        "timezone": load_timezone(os.getenv("TIMEZONE")),
+    }
+
+    drive = None
+    if args.format == "zip" and os.getenv("SERVICE_ACCOUNT_FILE"):
+        from google_drive import GoogleDrive
+
+        drive = GoogleDrive(service_account_file=os.getenv("SERVICE_ACCOUNT_FILE"))
+
+    output = args.output or "journal-export.{}".format(EXTENSIONS[args.format])
+    if output == "-":
+        export(sys.stdout.buffer, args.format, db_session, drive=drive, **filters)
+    else:
+        export_to_path(output, args.format, db_session, drive=drive, **filters)
+        print("Wrote {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# after a failed search, wait this long before asking giphy again
+RETRY_SECONDS = 60
+
+
+class GifPool(object):
+    # Per-query pools of GIF urls kept in memory. A pick never waits on
+    # giphy: it returns a random url from the pool (or "" while the first
+    # search for a query is still running) and, once the pool is older than
+    # ttl, refreshes it in the background with a single search of `limit`
+    # results.
+
+    def __init__(self, search, ttl=None, limit=None):
+        if ttl is None:
+            ttl = float(os.getenv("GIPHY_CACHE_TTL_SECONDS", "3600"))
+        if limit is None:
+            limit = int(os.getenv("GIPHY_SEARCH_LIMIT", "50"))
+
+        # search(query, limit) -> list of urls
+        self.search = search
+        self.ttl = ttl
+        self.limit = max(limit, 1)
+
+        self._pools = {}  # query -> (urls, refresh_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="giphy")
+
+    def pick(self, query):
+        with self._lock:
+            urls, refresh_at = self._pools.get(query, ([], 0))
+            if refresh_at <= time.monotonic() and query not in self._refreshing:
+                self._refreshing.add(query)
+                self._executor.submit(self._refresh, query)
+
+        return random.choice(urls) if urls else ""
+
+    def _refresh(self, query):
+        try:
+            urls = self.search(query, self.limit)
+            refresh_at = time.monotonic() + self.ttl
+        except Exception:
+            logging.exception("Giphy search for %r failed", query)
+            urls = None
+            refresh_at = time.monotonic() + min(self.ttl, RETRY_SECONDS)
+
+        with self._lock:
+            if not urls:
+                # keep serving what we had
+                urls = self._pools.get(query, ([], 0))[0]
+            self._pools[query] = (urls, refresh_at)
+            self._refreshing.discard(query)
@@ -1,15 +1,83 @@
+import http.client
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import google_auth_httplib2
+import httplib2
 from apiclient import discovery
-from apiclient.http import MediaFileUpload
+from apiclient.errors import HttpError
+from apiclient.http import MediaFileUpload, MediaIoBaseDownload
+from google.auth.exceptions import TransportError
 from google.oauth2 import service_account
 
+from metrics import GOOGLE_CALLS, GOOGLE_ERRORS, stage
 from utils import hex_to_rgb
 
+# resumable upload chunks must be a multiple of 256 KiB
+UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# Drive reports rate limits as 403 with one of these reasons
+RATE_LIMIT_REASONS = (
+    "rateLimitExceeded",
+    "userRateLimitExceeded",
+    "RATE_LIMIT_EXCEEDED",
+)
+
 
 class GoogleDrive(object):
-    def __init__(self, service_account_file):
-        credentials = self._get_credentials(service_account_file)
-        self.drive_service = self._get_drive_instance(credentials)
-        self.docs_service = self._get_docs_instance(credentials)
+    def __init__(
+        self,
+        service_account_file,
+        upload_chunk_size=None,
+        upload_retries=None,
+        http_pool_size=None,
+        http_timeout=None,
+        max_cached_cursors=None,
+    ):
+        if upload_chunk_size is None:
+            upload_chunk_size = int(
+                os.getenv("DRIVE_UPLOAD_CHUNK_SIZE", str(8 * 1024 * 1024))
+            )
+        if upload_retries is None:
+            upload_retries = int(os.getenv("DRIVE_UPLOAD_RETRIES", "5"))
+        if http_pool_size is None:
+            http_pool_size = int(os.getenv("GOOGLE_HTTP_POOL_SIZE", "8"))
+        if http_timeout is None:
+            http_timeout = float(os.getenv("GOOGLE_HTTP_TIMEOUT_SECONDS", "60"))
+        if max_cached_cursors is None:
+            max_cached_cursors = int(os.getenv("MAX_CACHED_CHATS", "1024"))
+
+        chunks = max(1, -(-upload_chunk_size // UPLOAD_CHUNK_ALIGNMENT))
+        self.upload_chunk_size = chunks * UPLOAD_CHUNK_ALIGNMENT
+        self.upload_retries = upload_retries
+
+        self.credentials = self._get_credentials(service_account_file)
+
+        # api clients are built on first use from the discovery documents
+        # bundled with google-api-python-client, so startup needs no network
+        self._drive_service = None
+        self._docs_service = None
+        self._service_lock = threading.Lock()
+
+        # httplib2 transports are not thread-safe, so every call (journal
+        # writer, outbox, upload workers) leases one from the pool
+        self.http_pool = HttpPool(self.credentials, http_pool_size, http_timeout)
+
+        # end-of-body index per document, advanced locally after each write;
+        # least recently written documents (past days) are evicted first
+        self.max_cached_cursors = max(max_cached_cursors, 1)
+        self._end_cursors = OrderedDict()
+        self._cursor_lock = threading.Lock()
+        # writes to one document are serialized, different documents go in
+        # parallel. document_id -> [lock, number of writers holding or
+        # waiting for it]
+        self._doc_locks = {}
 
     def _get_credentials(self, service_account_file):
         SCOPES = [
@@ -24,10 +92,47 @@ class GoogleDrive(object):
         return credentials
 
     def _get_drive_instance(self, credentials):
-        return discovery.build("drive", "v3", credentials=credentials)
+        return discovery.build(
+            "drive",
+            "v3",
+            credentials=credentials,
+            static_discovery=True,
+            cache_discovery=False,
+        )
 
     def _get_docs_instance(self, credentials):
-        return discovery.build("docs", "v1", credentials=credentials)
+        return discovery.build(
+            "docs",
+            "v1",
+            credentials=credentials,
+            static_discovery=True,
+            cache_discovery=False,
+        )
+
+    @property
+    def drive_service(self):
+        if self._drive_service is None:
+            with self._service_lock:
+                if self._drive_service is None:
+                    self._drive_service = self._get_drive_instance(self.credentials)
+        return self._drive_service
+
+    @property
+    def docs_service(self):
+        if self._docs_service is None:
+            with self._service_lock:
+                if self._docs_service is None:
+                    self._docs_service = self._get_docs_instance(self.credentials)
+        return self._docs_service
+
+    def _execute(self, request):
+        GOOGLE_CALLS.inc(request.methodId)
+        try:
+            with self.http_pool.lease() as http:
+                return request.execute(http=http)
+        except Exception as e:
+            GOOGLE_ERRORS.inc(request.methodId, _error_status(e))
+            raise
 
     def create_folder(self, name, folder_parent_id):
         folder_metadata = {
@@ -36,20 +141,71 @@ class GoogleDrive(object):
             "parents": [folder_parent_id],
         }
 
-        return self.drive_service.files().create(body=folder_metadata).execute()
+        return self._execute(self.drive_service.files().create(body=folder_metadata))
 
-    def upload_media(self, full_filepath, mimetype, folder_parent_id):
+    def upload_media(self, full_filepath, mimetype, folder_parent_id, name=None):
         file_metadata = {
-            "name": full_filepath.split("/")[-1],
+            "name": name or full_filepath.split("/")[-1],
             "parents": [folder_parent_id],
         }
 
-        media = MediaFileUpload(full_filepath, mimetype=mimetype)
-        return (
-            self.drive_service.files()
-            .create(body=file_metadata, media_body=media, fields="id,name")
-            .execute()
+        media = MediaFileUpload(
+            full_filepath,
+            mimetype=mimetype,
+            chunksize=self.upload_chunk_size,
+            resumable=True,
         )
+        request = self.drive_service.files().create(
+            body=file_metadata, media_body=media, fields="id,name"
+        )
+
+        with stage("upload"), self.http_pool.lease() as http:
+            return self._upload_chunks(request, http, full_filepath)
+
+    def _upload_chunks(self, request, http, full_filepath):
+        response = None
+        failures = 0
+        while response is None:
+            GOOGLE_CALLS.inc(request.methodId)
+            try:
+                # no retries inside next_chunk, this loop is the only layer
+                _, response = request.next_chunk(http=http, num_retries=0)
+                failures = 0
+            except Exception as e:
+                GOOGLE_ERRORS.inc(request.methodId, _error_status(e))
+                if not is_transient_error(e):
+                    raise
+
+                failures += 1
+                if failures > self.upload_retries:
+                    raise
+
+                # the next call asks Drive how much it already has and resumes
+                # from there instead of starting over
+                logging.warning(
+                    "Upload of %s interrupted (%s), resuming", full_filepath, e
+                )
+                time.sleep(min(2**failures, 30))
+
+        return response
+
+    def download_media(self, file_id, fp):
+        # streams a Drive file into fp in upload-sized chunks
+        with stage("download"), self.http_pool.lease() as http:
+            request = self.drive_service.files().get_media(fileId=file_id)
+            request.http = http
+            downloader = MediaIoBaseDownload(
+                fp, request, chunksize=self.upload_chunk_size
+            )
+
+            done = False
+            while not done:
+                GOOGLE_CALLS.inc(request.methodId)
+                try:
+                    _, done = downloader.next_chunk(num_retries=self.upload_retries)
+                except Exception as e:
+                    GOOGLE_ERRORS.inc(request.methodId, _error_status(e))
+                    raise
 
     def create_document(self, name, folder_parents_id):
         file_metadata = {
@@ -58,27 +214,105 @@ class GoogleDrive(object):
             "parents": [folder_parents_id],
         }
 
-        return self.drive_service.files().create(body=file_metadata).execute()
+        response = self._execute(self.drive_service.files().create(body=file_metadata))
+
+        # a new document is a single empty paragraph, so text starts at index 1
+        self._remember_cursor(response.get("id"), 1)
+        return response
 
     def get_end_cursor_position(self, document_id):
-        result = self.docs_service.documents().get(documentId=document_id).execute()
+        with stage("cursor_fetch"):
+            result = self._execute(
+                self.docs_service.documents().get(documentId=document_id)
+            )
         return result.get("body")["content"][-1]["endIndex"] - 1
 
+    def _get_cached_cursor_position(self, document_id):
+        with self._cursor_lock:
+            cursor = self._end_cursors.get(document_id)
+        if cursor is None:
+            cursor = self.get_end_cursor_position(document_id)
+        return cursor
+
+    def _remember_cursor(self, document_id, cursor):
+        with self._cursor_lock:
+            self._end_cursors[document_id] = cursor
+            self._end_cursors.move_to_end(document_id)
+            while len(self._end_cursors) > self.max_cached_cursors:
+                self._end_cursors.popitem(last=False)
+
+    @contextmanager
+    def _document_lock(self, document_id):
+        with self._cursor_lock:
+            entry = self._doc_locks.setdefault(document_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._cursor_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._doc_locks[document_id]
+
     def write_document(self, document_id, body, is_bold=False, rgb_hex="000000"):
+        return self.write_document_batch(
+            document_id, [{"body": body, "is_bold": is_bold, "rgb_hex": rgb_hex}]
+        )
+
+    def write_document_batch(self, document_id, entries):
+        # entries are dicts with a "body" and optional "is_bold"/"rgb_hex",
+        # appended in order with a single batchUpdate
+        with self._document_lock(document_id):
+            try:
+                return self._write_document_batch(document_id, entries)
+            except HttpError as e:
+                if not _is_index_error(e):
+                    raise
+
+                # the document changed behind our back, re-sync and retry once
+                with self._cursor_lock:
+                    self._end_cursors.pop(document_id, None)
+                return self._write_document_batch(document_id, entries)
+
+    def _write_document_batch(self, document_id, entries):
+        cursor = self._get_cached_cursor_position(document_id)
+
+        requests = []
+        for entry in entries:
+            text = "{}\n\n".format(entry["body"])
+            requests.extend(
+                self._append_requests(
+                    cursor,
+                    text,
+                    doc_text_length(entry["body"]),
+                    entry.get("is_bold", False),
+                    entry.get("rgb_hex", "000000"),
+                )
+            )
+            cursor += doc_text_length(text)
+
+        with stage("batch_update"):
+            response = self._execute(
+                self.docs_service.documents().batchUpdate(
+                    documentId=document_id, body={"requests": requests}
+                )
+            )
+        self._remember_cursor(document_id, cursor)
+        return response
+
+    def _append_requests(self, start_index, text, styled_length, is_bold, rgb_hex):
         PIXELS_IN_8BIT_COLOR = 256
-        body_length = len(body)
         red, green, blue = hex_to_rgb(rgb_hex)
+        end_index = start_index + styled_length
 
-        start_index = self.get_end_cursor_position(document_id)
-        end_index = start_index + body_length
-
-        requests = [
+        return [
             {
                 "insertText": {
                     "location": {
                         "index": start_index,
                     },
-                    "text": "{}\n\n".format(body),
+                    "text": text,
                 },
             },
             {
@@ -107,8 +341,87 @@ class GoogleDrive(object):
             },
         ]
 
-        return (
-            self.docs_service.documents()
-            .batchUpdate(documentId=document_id, body={"requests": requests})
-            .execute()
+
+class HttpPool(object):
+    # A bounded pool of authorized httplib2 transports, each keeping its
+    # connections to Google alive between calls. A transport is used by one
+    # thread at a time; the most recently returned one is handed out first so
+    # its connections are still warm.
+
+    def __init__(self, credentials, size, timeout):
+        self.credentials = credentials
+        self.size = max(size, 1)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self):
+        try:
+            http = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if not create:
+                http = self._idle.get()
+            else:
+                try:
+                    http = self._new_http()
+                except BaseException:
+                    # give the slot back, or enough failures would leave
+                    # every later lease waiting on an empty pool
+                    with self._lock:
+                        self._created -= 1
+                    raise
+
+        try:
+            yield http
+        finally:
+            self._idle.put(http)
+
+    def _new_http(self):
+        return google_auth_httplib2.AuthorizedHttp(
+            self.credentials, http=httplib2.Http(timeout=self.timeout)
         )
+
+
+def doc_text_length(text):
+    # Docs indexes count UTF-16 code units, so emoji take up two positions
+    return len(text.encode("utf-16-le")) // 2
+
+
+def is_transient_error(error):
+    # worth retrying: 5xx, rate limits, timeouts and network failures,
+    # including a token refresh that could not reach Google
+    if isinstance(error, HttpError):
+        return error.resp.status in RETRYABLE_STATUS_CODES or _is_rate_limit(error)
+    return isinstance(
+        error,
+        (httplib2.HttpLib2Error, http.client.HTTPException, OSError, TransportError),
+    )
+
+
+def _is_rate_limit(error):
+    if error.resp.status != 403:
+        return False
+
+    try:
+        details = json.loads(error.content)["error"]
+        reasons = [entry.get("reason") for entry in details.get("errors", [])]
+        reasons += [entry.get("reason") for entry in details.get("details", [])]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return False
+    return any(reason in RATE_LIMIT_REASONS for reason in reasons)
+
+
+def _error_status(error):
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return type(error).__name__
+
+
+def _is_index_error(error):
+    return error.resp.status == 400 and "index" in str(error).lower()
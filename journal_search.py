@@ -0,0 +1,75 @@
+import re
+
+import models
+from sqlalchemy import DateTime, Text, text
+
+# Full-text search over the chat's own entries, backed by the conversation_fts
+# index (see database._add_full_text_search). Matches are ranked with bm25 and
+# the matched terms in each snippet are wrapped in HIGHLIGHT markers.
+
+HIGHLIGHT = ("\x02", "\x03")
+
+SEARCH_ENTRIES = text(
+    "SELECT conversation.date AS date, "
+    "snippet(conversation_fts, 0, :open, :close, '…', 16) AS snippet "
+    "FROM conversation_fts JOIN conversation "
+    "ON conversation.id = conversation_fts.rowid "
+    "WHERE conversation_fts MATCH :query "
+    "AND conversation.chat_id = :chat_id AND conversation.source = 'human' "
+    "ORDER BY conversation_fts.rank LIMIT :limit"
+).columns(date=DateTime, snippet=Text)
+
+
+class JournalSearch(object):
+    def __init__(self, db_session):
+        self.db_session = db_session
+
+    def search(self, chat_id, terms, timezone=None, limit=5):
+        # [(day, snippet, doc goog_id or None)], best match first; days are
+        # in the chat's journal timezone like the day docs
+        query = match_query(terms)
+        if not query:
+            return []
+
+        rows = self.db_session.execute(
+            SEARCH_ENTRIES,
+            {
+                "chat_id": chat_id,
+                "query": query,
+                "open": HIGHLIGHT[0],
+                "close": HIGHLIGHT[1],
+                "limit": limit,
+            },
+        ).fetchall()
+
+        results = []
+        for entry_date, snippet in rows:
+            # conversation dates are naive server local time
+            if timezone is not None:
+                entry_date = entry_date.astimezone(timezone)
+            results.append((entry_date.date(), snippet))
+
+        doc_ids = self._doc_ids(chat_id, {day for day, _ in results})
+        return [
+            (day, snippet, doc_ids.get(day.isoformat())) for day, snippet in results
+        ]
+
+    def _doc_ids(self, chat_id, days):
+        if not days:
+            return {}
+
+        rows = self.db_session.query(models.Doc.key, models.Doc.goog_id).filter(
+            models.Doc.chat_id == chat_id,
+            models.Doc.key.in_([day.isoformat() for day in days]),
+        )
+        return dict(rows)
+
+
+def match_query(terms):
+    # every word must match, as a quoted string so punctuation in the user's
+    # text is never read as FTS5 syntax; a trailing * keeps prefix search
+    words = re.findall(r"\w+\*?", terms)
+    return " ".join(
+        '"{}"*'.format(word[:-1]) if word.endswith("*") else '"{}"'.format(word)
+        for word in words
+    )
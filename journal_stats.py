@@ -0,0 +1,138 @@
+from collections import Counter
+from datetime import date, timedelta
+
+import models
+from sqlalchemy import text
+
+# Stats are kept as running counters so reading them never scans the
+# conversation table. A "journal day" is a day with at least one entry from
+# the human side of the chat; streaks count consecutive journal days.
+
+UPSERT_DAILY_STAT = text(
+    "INSERT INTO daily_stat (chat_id, day, category, source, count) "
+    "VALUES (:chat_id, :day, :category, :source, :count) "
+    "ON CONFLICT (chat_id, day, category, source) "
+    "DO UPDATE SET count = count + excluded.count"
+)
+
+# every SET expression sees the row as it was before the update
+NEXT_STREAK = (
+    "CASE WHEN last_entry_day = :day THEN current_streak "
+    "WHEN last_entry_day = :yesterday THEN current_streak + 1 ELSE 1 END"
+)
+UPSERT_JOURNAL_DAY = text(
+    "INSERT INTO chat_stat (chat_id, entries, current_streak, longest_streak, "
+    "last_entry_day) VALUES (:chat_id, :entries, 1, 1, :day) "
+    "ON CONFLICT (chat_id) DO UPDATE SET "
+    "entries = entries + excluded.entries, "
+    "current_streak = {next_streak}, "
+    "longest_streak = MAX(longest_streak, {next_streak}), "
+    "last_entry_day = :day".format(next_streak=NEXT_STREAK)
+)
+
+UPSERT_REFLECTION_DAY = text(
+    "INSERT INTO chat_stat (chat_id, entries, current_streak, longest_streak, "
+    "last_reflection_day) VALUES (:chat_id, 0, 0, 0, :day) "
+    "ON CONFLICT (chat_id) DO UPDATE SET last_reflection_day = :day"
+)
+
+
+class JournalStats(object):
+    def __init__(self, db_session):
+        self.db_session = db_session
+
+    def record(self, chat_id, day, entries):
+        # called inside the transaction that adds the conversation rows, with
+        # entries as (category, source) pairs for one chat and day
+        day_key = day.isoformat()
+
+        counts = Counter(entries)
+        for (category, source), count in counts.items():
+            self.db_session.execute(
+                UPSERT_DAILY_STAT,
+                {
+                    "chat_id": chat_id,
+                    "day": day_key,
+                    "category": category,
+                    "source": source,
+                    "count": count,
+                },
+            )
+
+        human_entries = sum(
+            count for (_, source), count in counts.items() if source == "human"
+        )
+        if human_entries:
+            self.db_session.execute(
+                UPSERT_JOURNAL_DAY,
+                {
+                    "chat_id": chat_id,
+                    "entries": human_entries,
+                    "day": day_key,
+                    "yesterday": (day - timedelta(days=1)).isoformat(),
+                },
+            )
+
+        if any(category == "reflection" for category, _ in counts):
+            self.db_session.execute(
+                UPSERT_REFLECTION_DAY, {"chat_id": chat_id, "day": day_key}
+            )
+
+    def day_counts(self, chat_id, day):
+        # {(category, source): count} for one day
+        rows = self.db_session.query(
+            models.DailyStat.category,
+            models.DailyStat.source,
+            models.DailyStat.count,
+        ).filter(
+            models.DailyStat.chat_id == chat_id,
+            models.DailyStat.day == day.isoformat(),
+        )
+        return {(category, source): count for category, source, count in rows}
+
+    def summary(self, chat_id, today):
+        chat_stat = (
+            self.db_session.query(models.ChatStat)
+            .filter(models.ChatStat.chat_id == chat_id)
+            .first()
+        )
+        day_counts = self.day_counts(chat_id, today)
+
+        summary = {
+            "entries": 0,
+            "current_streak": 0,
+            "longest_streak": 0,
+            "last_entry_day": None,
+            "last_reflection_day": None,
+            "today_entries": sum(
+                count for (_, source), count in day_counts.items() if source == "human"
+            ),
+            "today_by_category": Counter(
+                {
+                    category or "journal": count
+                    for (category, source), count in day_counts.items()
+                    if source == "human"
+                }
+            ),
+        }
+        if chat_stat is None:
+            return summary
+
+        last_entry_day = _parse_day(chat_stat.last_entry_day)
+        current_streak = chat_stat.current_streak or 0
+        # a streak survives until the end of the day after the last entry
+        if last_entry_day is None or last_entry_day < today - timedelta(days=1):
+            current_streak = 0
+
+        summary.update(
+            entries=chat_stat.entries or 0,
+            current_streak=current_streak,
+            longest_streak=chat_stat.longest_streak or 0,
+            last_entry_day=last_entry_day,
+            last_reflection_day=_parse_day(chat_stat.last_reflection_day),
+        )
+        return summary
+
+
+def _parse_day(value):
+    return date.fromisoformat(value) if value else None
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from metrics import REGISTRY, Histogram
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+LOOP_LAG_SECONDS = REGISTRY.register(
+    Histogram(
+        "event_loop_lag_seconds",
+        "How late the event loop ran the watchdog heartbeat.",
+        [],
+    )
+)
+LOOP_BLOCKED_SECONDS = REGISTRY.register(
+    Histogram(
+        "event_loop_blocked_seconds",
+        "Stalls of the event loop longer than LOOP_WATCHDOG_MS, by handler.",
+        ["handler"],
+    )
+)
+
+
+class LoopWatchdog(object):
+    # Finds code that blocks the event loop. A heartbeat task records how late
+    # the loop wakes it up; a separate thread checks the heartbeat and, when
+    # it is older than `threshold`, samples the loop thread's stack. Once the
+    # loop is back the stall is logged with that stack and charged to the
+    # handler it happened in (the outermost frame from this repo), so
+    # handlers can be ranked by how long they held the loop.
+    #
+    # Off unless LOOP_WATCHDOG_MS is set.
+
+    def __init__(self, threshold=None):
+        if threshold is None:
+            threshold = int(os.getenv("LOOP_WATCHDOG_MS", "0")) / 1000
+
+        self.threshold = threshold
+        # beat often enough that a stall is noticed well within the threshold
+        self.interval = threshold / 4
+        # handler -> [stalls, total seconds, longest]
+        self.stalls = {}
+
+        self._last_beat = None
+        self._stall = None  # (started, handler, stack) of the current stall
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._heartbeat = None
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    def start(self):
+        if not self.enabled or self._heartbeat is not None:
+            return
+
+        loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat = asyncio.get_running_loop().create_task(self._beat())
+        self._thread = threading.Thread(
+            target=self._watch,
+            args=(loop_thread_id,),
+            name="loop-watchdog",
+            daemon=True,
+        )
+        self._thread.start()
+        logging.info(
+            "Watching the event loop for stalls over %gms", self.threshold * 1000
+        )
+
+    async def stop(self):
+        if self._heartbeat is None:
+            return
+
+        self._stopped.set()
+        self._heartbeat.cancel()
+        try:
+            await self._heartbeat
+        except asyncio.CancelledError:
+            pass
+        self._heartbeat = None
+        self._thread.join()
+
+        for handler, (count, total, longest) in self.ranking():
+            logging.info(
+                "Event loop blocked %d times in %s, %.0fms in total, longest %.0fms",
+                count,
+                handler,
+                total * 1000,
+                longest * 1000,
+            )
+
+    def ranking(self):
+        # handlers that blocked the loop, longest total first
+        with self._lock:
+            stalls = [(handler, tuple(entry)) for handler, entry in self.stalls.items()]
+        return sorted(stalls, key=lambda item: item[1][1], reverse=True)
+
+    async def _beat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            LOOP_LAG_SECONDS.observe(max(loop.time() - expected, 0))
+
+            now = time.monotonic()
+            with self._lock:
+                self._last_beat = now
+                stall, self._stall = self._stall, None
+            if stall is not None:
+                self._report(stall, now)
+
+    def _watch(self, loop_thread_id):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                last_beat = self._last_beat
+                sampled = self._stall is not None
+            overdue = time.monotonic() - last_beat - self.interval
+            if sampled or overdue < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(loop_thread_id)
+            stack = callback_stack(traceback.extract_stack(frame)) if frame else None
+            if not stack:
+                # waiting in select for the GIL held by other threads, which
+                # shows as lag but is not a callback holding the loop
+                continue
+            with self._lock:
+                # the loop may have caught up while the stack was taken
+                if self._last_beat == last_beat:
+                    self._stall = (last_beat, blocking_handler(stack), stack)
+
+    def _report(self, stall, resumed_at):
+        started, handler, stack = stall
+        duration = resumed_at - started - self.interval
+        LOOP_BLOCKED_SECONDS.observe(duration, handler)
+        with self._lock:
+            entry = self.stalls.setdefault(handler, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+        logging.warning(
+            "Event loop blocked for %.0fms in %s:\n%s",
+            duration * 1000,
+            handler,
+            "".join(traceback.format_list(stack)).rstrip(),
+        )
+
+
+def callback_stack(stack):
+    # the frames below asyncio's Handle._run, which runs every task step and
+    # callback; None when the loop is not running one
+    for index in range(len(stack) - 1, -1, -1):
+        frame = stack[index]
+        if frame.name == "_run" and frame.filename.endswith(
+            os.path.join("asyncio", "events.py")
+        ):
+            return stack[index + 1 :]
+    return None
+
+
+def blocking_handler(stack):
+    # the outermost frame of our own code in the running callback is the
+    # handler or job that made the blocking call, e.g. "bot.show_stats"
+    for frame in stack:
+        filename = os.path.abspath(frame.filename)
+        if filename.startswith(REPO_ROOT + os.sep) and "site-packages" not in filename:
+            module = os.path.splitext(os.path.relpath(filename, REPO_ROOT))[0]
+            return "{}.{}".format(module.replace(os.sep, "."), frame.name)
+
+    if stack:
+        return "{}:{}".format(os.path.basename(stack[-1].filename), stack[-1].name)
+    return "unknown"
+
@@ -0,0 +1,84 @@
+import hashlib
+import os
+import tempfile
+from urllib.parse import urlparse
+
+import httpx
+from telegram.error import NetworkError
+
+MEDIA_DIRECTORY = "./media"
+
+_http_client = None
+
+
+def _get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=120.0))
+    return _http_client
+
+
+def new_spool_path(suffix=".part"):
+    os.makedirs(MEDIA_DIRECTORY, exist_ok=True)
+    file_descriptor, path = tempfile.mkstemp(dir=MEDIA_DIRECTORY, suffix=suffix)
+    os.close(file_descriptor)
+    return path
+
+
+async def download_to_spool(media_file, chunk_size=None):
+    # stream a telegram File to disk so memory use stays at one chunk,
+    # whatever the size of the file. Returns the spool path and the sha256
+    # of the content, computed on the way through.
+    if chunk_size is None:
+        chunk_size = int(os.getenv("MEDIA_DOWNLOAD_CHUNK_SIZE", str(64 * 1024)))
+
+    spool_path = new_spool_path()
+    content_hash = hashlib.sha256()
+    try:
+        with open(spool_path, "wb") as spool_file:
+            if urlparse(media_file.file_path).scheme in ("http", "https"):
+                await _download(
+                    media_file.file_path, spool_file, content_hash, chunk_size
+                )
+            else:
+                # local bot API server mode hands out paths on this machine
+                with open(media_file.file_path, "rb") as source_file:
+                    for chunk in iter(lambda: source_file.read(chunk_size), b""):
+                        content_hash.update(chunk)
+                        spool_file.write(chunk)
+    except BaseException:
+        os.remove(spool_path)
+        raise
+
+    return spool_path, content_hash.hexdigest()
+
+
+async def _download(url, spool_file, content_hash, chunk_size):
+    # the file url carries the bot token, so httpx errors (which quote the
+    # url) are replaced by ones that do not
+    client = _get_http_client()
+    try:
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(chunk_size):
+                content_hash.update(chunk)
+                spool_file.write(chunk)
+    except httpx.HTTPStatusError as e:
+        error = NetworkError(
+            "Telegram file download failed with HTTP {}".format(e.response.status_code)
+        )
+    except httpx.HTTPError as e:
+        error = NetworkError(
+            "Telegram file download failed: {}".format(type(e).__name__)
+        )
+    else:
+        return
+    # raised outside the except block so the original is not chained
+    raise error
+
+
+async def close():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import media_spool
+
+
+class MediaUploader(object):
+    # Downloads and uploads media in the background on a bounded pool of
+    # worker threads. At most max_in_flight files are accepted at once;
+    # beyond that submit() refuses new work so callers can push back instead
+    # of spooling an unbounded backlog. Uploads that fail are handed to the
+    # outbox, which keeps retrying; their task resolves to None.
+
+    def __init__(
+        self,
+        conversation,
+        journal,
+        outbox=None,
+        max_workers=None,
+        max_in_flight=None,
+    ):
+        if max_workers is None:
+            max_workers = int(os.getenv("MEDIA_UPLOAD_WORKERS", "4"))
+        if max_in_flight is None:
+            max_in_flight = int(os.getenv("MEDIA_UPLOAD_MAX_IN_FLIGHT", "16"))
+
+        self.conversation = conversation
+        self.journal = journal
+        self.outbox = outbox
+        self.max_in_flight = max(max_in_flight, 1)
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="media-upload"
+        )
+        self._tasks = set()
+
+    @property
+    def in_flight(self):
+        return len(self._tasks)
+
+    def submit(self, chat_id, media_file, mimetype, extension=None, caption=None):
+        if self.in_flight >= self.max_in_flight:
+            return None
+
+        task = asyncio.get_running_loop().create_task(
+            self._save(chat_id, media_file, mimetype, extension, caption)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def stop(self):
+        if self._tasks:
+            logging.info("Waiting for %d media uploads", self.in_flight)
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def _save(self, chat_id, media_file, mimetype, extension, caption):
+        loop = asyncio.get_running_loop()
+        file_unique_id = media_file.file_unique_id
+
+        # resent and forwarded files keep their file_unique_id, so most
+        # duplicates are caught before downloading anything
+        existing = await loop.run_in_executor(
+            self._executor,
+            partial(
+                self.conversation.find_media, chat_id, file_unique_id=file_unique_id
+            ),
+        )
+
+        content_hash = None
+        if existing is None:
+            spool_path, content_hash = await media_spool.download_to_spool(media_file)
+            existing = await loop.run_in_executor(
+                self._executor,
+                partial(
+                    self.conversation.find_media, chat_id, content_hash=content_hash
+                ),
+            )
+            if existing is not None:
+                os.remove(spool_path)
+
+        if existing is not None:
+            file_name, goog_id = existing
+        else:
+            try:
+                file_name, response = await loop.run_in_executor(
+                    self._executor,
+                    partial(
+                        self.conversation.upload_media,
+                        chat_id,
+                        spool_path,
+                        mimetype,
+                        extension=extension,
+                    ),
+                )
+            except Exception:
+                logging.exception("Upload failed, handing %s to the outbox", spool_path)
+                await loop.run_in_executor(
+                    self._executor,
+                    partial(
+                        self.conversation.defer_media,
+                        chat_id,
+                        spool_path,
+                        mimetype,
+                        extension=extension,
+                        file_unique_id=file_unique_id,
+                        content_hash=content_hash,
+                        caption=caption,
+                    ),
+                )
+                if self.outbox is not None:
+                    self.outbox.notify()
+                return None
+            goog_id = response.get("id")
+
+        # journal rows go through the writer so they stay in order
+        await self.journal.submit(
+            self.conversation.record_media,
+            chat_id,
+            file_name,
+            goog_id,
+            mimetype,
+            file_unique_id=file_unique_id,
+            content_hash=content_hash,
+            duplicate=existing is not None,
+            caption=caption,
+        )
+
+        return file_name
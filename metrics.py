@@ -0,0 +1,253 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds in seconds, from a warm sqlite commit to a slow upload
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram(object):
+    # Bucketed latencies per label set. An observation is a bisect and a few
+    # additions under an uncontended lock, cheap enough for every Google call.
+
+    def __init__(self, name, help_text, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += seconds
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def summary(self):
+        # label values -> (count, mean, p50, p99); quantiles are the upper
+        # bound of the bucket they fall in
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+
+        result = {}
+        for labels, values in sorted(series.items()):
+            counts, total = values[:-1], values[-1]
+            count = sum(counts)
+            result[labels] = (
+                count,
+                total / count,
+                self._quantile(counts, count, 0.5),
+                self._quantile(counts, count, 0.99),
+            )
+        return result
+
+    def _quantile(self, counts, count, quantile):
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= quantile * count:
+                return self.buckets[index] if index < len(self.buckets) else None
+        return None
+
+    def render(self):
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+
+        lines = []
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (None,), values[:-1]):
+                cumulative += bucket_count
+                le = "+Inf" if bound is None else repr(bound)
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _labels(self.label_names + ("le",), labels + (le,)),
+                        cumulative,
+                    )
+                )
+            label_text = _labels(self.label_names, labels)
+            lines.append("{}_sum{} {!r}".format(self.name, label_text, values[-1]))
+            lines.append("{}_count{} {}".format(self.name, label_text, cumulative))
+        return _family(self.name, self.help_text, "histogram", lines)
+
+
+class Counter(object):
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [
+            "{}{} {}".format(self.name, _labels(self.label_names, labels), value)
+            for labels, value in sorted(self.values().items())
+        ]
+        return _family(self.name, self.help_text, "counter", lines)
+
+
+class Gauge(object):
+    # read from a callback when scraped, e.g. a queue depth
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            logging.exception("Could not read gauge %s", self.name)
+            return ""
+        return _family(
+            self.name, self.help_text, "gauge", ["{} {}".format(self.name, value)]
+        )
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "".join(metric.render() for metric in self.metrics)
+
+
+# metrics are process-wide, like the logging config
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "journal_stage_seconds",
+        "Time spent in each stage of saving a journal entry or media file.",
+        ["stage"],
+    )
+)
+GOOGLE_CALLS = REGISTRY.register(
+    Counter(
+        "google_api_calls_total",
+        "Google Drive and Docs API requests, by method.",
+        ["method"],
+    )
+)
+GOOGLE_ERRORS = REGISTRY.register(
+    Counter(
+        "google_api_errors_total",
+        "Failed Google Drive and Docs API requests, by method and status.",
+        ["method", "status"],
+    )
+)
+TELEGRAM_SEND_SECONDS = REGISTRY.register(
+    Histogram(
+        "telegram_request_seconds",
+        "Latency of outbound Telegram bot API requests, by method.",
+        ["method"],
+    )
+)
+TELEGRAM_ERRORS = REGISTRY.register(
+    Counter(
+        "telegram_request_errors_total",
+        "Failed outbound Telegram bot API requests, by method.",
+        ["method"],
+    )
+)
+
+
+def stage(name):
+    # with stage("batch_update"): ...
+    return STAGE_SECONDS.time(name)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would drown the bot's own logs
+        pass
+
+
+def start_http_server(port, address="0.0.0.0"):
+    # serves /metrics from a daemon thread, off the bot's event loop; one
+    # thread is enough for a scraper and keeps gauges on a single db session
+    server = HTTPServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logging.info("Serving metrics on %s:%s/metrics", address, port)
+    return server
+
+
+def _family(name, help_text, kind, lines):
+    if not lines:
+        return ""
+    header = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, kind)]
+    return "\n".join(header + lines) + "\n"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = (
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return "{" + ",".join(pairs) + "}"
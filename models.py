@@ -1,57 +1,158 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, Text, Index, LargeBinary
 from database import Base
 
+class Chat(Base):
+	__tablename__ = 'chat'
+
+	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger, unique = True)
+	goog_id = Column(String(20))
+	date = Column(DateTime)
+
+	def __init__(self, chat_id = None, goog_id = None):
+		self.chat_id = chat_id
+		self.goog_id = goog_id
+		self.date = datetime.now()
+
 class Folder(Base):
 	__tablename__ = 'folder'
+	__table_args__ = (Index('ix_folder_chat_id_key', 'chat_id', 'key', unique = True),)
 
 	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger)
 	name = Column(String(20))
 	goog_id = Column(String(20), unique = True)
+	key = Column(String(20))
 	date = Column(DateTime)
 
-	def __init__(self, name = None,  goog_id = None):
+	def __init__(self, name = None,  goog_id = None, key = None, chat_id = None):
 		self.name = name
 		self.goog_id = goog_id
+		self.key = key
+		self.chat_id = chat_id
 		self.date = datetime.now()
 
 class Doc(Base):
 	__tablename__ = 'doc'
+	__table_args__ = (Index('ix_doc_chat_id_key', 'chat_id', 'key', unique = True),)
 	parent_folder_id = Column(Integer, ForeignKey('folder.id'))
 	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger)
 	name = Column(String(20))
 	goog_id = Column(String(20), unique = True)
+	key = Column(String(20))
 	date = Column(DateTime)
 
-	def __init__(self, name = None, goog_id = None):
+	def __init__(self, name = None, goog_id = None, key = None, chat_id = None):
 		self.name = name
 		self.goog_id = goog_id
+		self.key = key
+		self.chat_id = chat_id
 		self.date = datetime.now()
 
 class Media(Base):
 	__tablename__ = 'media'
+	__table_args__ = (
+		Index('ix_media_chat_id_file_unique_id', 'chat_id', 'file_unique_id'),
+		Index('ix_media_chat_id_content_hash', 'chat_id', 'content_hash'),
+	)
 	parent_folder_id = Column(Integer, ForeignKey('folder.id'))
 	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger)
 	name = Column(String(20))
 	goog_id = Column(String(20), unique = True)
+	file_unique_id = Column(String(64))
+	content_hash = Column(String(64))
 	date = Column(DateTime)
 
-	def __init__(self, name = None, goog_id = None):
+	def __init__(self, name = None, goog_id = None, chat_id = None, file_unique_id = None, content_hash = None):
 		self.name = name
 		self.goog_id = goog_id
+		self.chat_id = chat_id
+		self.file_unique_id = file_unique_id
+		self.content_hash = content_hash
 		self.date = datetime.now()
 
 
 class Conversation(Base):
 	__tablename__ = 'conversation'
+	__table_args__ = (
+		Index('ix_conversation_chat_id_date', 'chat_id', 'date'),
+		Index('ix_conversation_chat_id_category_source_date', 'chat_id', 'category', 'source', 'date'),
+	)
 	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger)
 	source = Column(String(20))
 	category = Column(String(20))
 	message = Column(Text)
 	date = Column(DateTime)
 
-	def __init__(self, source = None, message = None, category = ''):
+	def __init__(self, source = None, message = None, category = '', chat_id = None):
 		self.source = source
 		self.message = message
 		self.category = category
+		self.chat_id = chat_id
+		self.date = datetime.now()
+
+
+class Outbox(Base):
+	__tablename__ = 'outbox'
+	__table_args__ = (
+		Index('ix_outbox_status_chat_id_kind_doc_key', 'status', 'chat_id', 'kind', 'doc_key'),
+		Index('ix_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+	)
+	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger)
+	kind = Column(String(20))
+	doc_key = Column(String(20))
+	payload = Column(Text)
+	status = Column(String(20))
+	attempts = Column(Integer)
+	next_attempt_at = Column(DateTime)
+	last_error = Column(Text)
+	date = Column(DateTime)
+
+	def __init__(self, chat_id = None, kind = None, doc_key = None, payload = None):
+		self.chat_id = chat_id
+		self.kind = kind
+		self.doc_key = doc_key
+		self.payload = payload
+		self.status = 'pending'
+		self.attempts = 0
 		self.date = datetime.now()
+		self.next_attempt_at = self.date
+
+
+class DailyStat(Base):
+	__tablename__ = 'daily_stat'
+	__table_args__ = (
+		Index('ix_daily_stat_chat_id_day_category_source', 'chat_id', 'day', 'category', 'source', unique = True),
+	)
+	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger)
+	day = Column(String(10))
+	category = Column(String(20))
+	source = Column(String(20))
+	count = Column(Integer)
+
+
+class ChatStat(Base):
+	__tablename__ = 'chat_stat'
+	id = Column(Integer, primary_key = True)
+	chat_id = Column(BigInteger, unique = True)
+	entries = Column(Integer)
+	current_streak = Column(Integer)
+	longest_streak = Column(Integer)
+	last_entry_day = Column(String(10))
+	last_reflection_day = Column(String(10))
+
+
+class BotState(Base):
+	__tablename__ = 'bot_state'
+	__table_args__ = (Index('ix_bot_state_kind_key', 'kind', 'key', unique = True),)
+	id = Column(Integer, primary_key = True)
+	kind = Column(String(64))
+	key = Column(String(64))
+	value = Column(LargeBinary)
+	date = Column(DateTime)
@@ -0,0 +1,297 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import models
+from apiclient.errors import HttpError
+from google_drive import is_transient_error
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+# each kind is delivered by its own thread, so slow media uploads never hold
+# back journal lines
+KINDS = ("doc_entry", "media")
+
+
+class OutboxWorker(object):
+    # Delivers outbox rows (journal lines for google docs, media uploads that
+    # failed inline) committed by Conversation, each kind on its own thread.
+    # Rows are grouped per chat, kind and day and a group is only delivered
+    # from its oldest row, so entries reach each document in order. Failures
+    # back off exponentially with jitter up to max_delay and keep being retried
+    # for max_age, so a Google outage of a few hours costs nothing; rows
+    # survive restarts because they live in journal.sqlite.
+
+    def __init__(
+        self,
+        conversation,
+        batch_size=None,
+        poll_interval=None,
+        base_delay=None,
+        max_delay=None,
+        max_age=None,
+    ):
+        if batch_size is None:
+            batch_size = int(os.getenv("OUTBOX_BATCH_SIZE", "50"))
+        if poll_interval is None:
+            poll_interval = float(os.getenv("OUTBOX_POLL_SECONDS", "30"))
+        if base_delay is None:
+            base_delay = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "2"))
+        if max_delay is None:
+            max_delay = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "600"))
+        if max_age is None:
+            max_age = timedelta(hours=float(os.getenv("OUTBOX_MAX_AGE_HOURS", "72")))
+
+        self.conversation = conversation
+        self.batch_size = max(batch_size, 1)
+        self.poll_interval = poll_interval
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_age = max_age
+
+        self._executors = {
+            kind: ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="outbox-{}".format(kind)
+            )
+            for kind in KINDS
+        }
+        self._wakes = {kind: asyncio.Event() for kind in KINDS}
+        self._workers = {}
+
+    @property
+    def db_session(self):
+        return self.conversation.db_session
+
+    def start(self):
+        if self._workers:
+            return
+
+        loop = asyncio.get_running_loop()
+        self._workers = {kind: loop.create_task(self._run(kind)) for kind in KINDS}
+
+    async def stop(self):
+        # pending rows stay in the outbox and are delivered on the next start
+        if not self._workers:
+            return
+
+        for worker in self._workers.values():
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers = {}
+        for executor in self._executors.values():
+            executor.shutdown(wait=True)
+
+    def notify(self):
+        for wake in self._wakes.values():
+            wake.set()
+
+    def pending(self):
+        return (
+            self.db_session.query(func.count())
+            .select_from(models.Outbox)
+            .filter(models.Outbox.status == "pending")
+            .scalar()
+        )
+
+    async def _run(self, kind):
+        loop = asyncio.get_running_loop()
+        wake = self._wakes[kind]
+        while True:
+            wake.clear()
+            try:
+                wait = await loop.run_in_executor(
+                    self._executors[kind], self.deliver_due, kind
+                )
+            except Exception:
+                logging.exception("Outbox delivery of %s rows failed", kind)
+                wait = self.poll_interval
+            if kind == "media":
+                # delivered media adds journal lines for the doc worker
+                self._wakes["doc_entry"].set()
+
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def deliver_due(self, kind):
+        # deliver every group of this kind whose oldest row is due, then
+        # return how long to sleep until the next one is
+        while True:
+            heads = self._due_heads(kind)
+            if not heads:
+                break
+            for head in heads:
+                self._deliver_group(head)
+
+        next_attempt_at = (
+            self.db_session.query(func.min(models.Outbox.next_attempt_at))
+            .filter(models.Outbox.status == "pending", models.Outbox.kind == kind)
+            .scalar()
+        )
+        self.db_session.commit()
+        if next_attempt_at is None:
+            return self.poll_interval
+
+        wait = (next_attempt_at - datetime.now()).total_seconds()
+        return min(max(wait, 0), self.poll_interval)
+
+    def _due_heads(self, kind):
+        head_ids = [
+            row[0]
+            for row in self.db_session.query(func.min(models.Outbox.id))
+            .filter(models.Outbox.status == "pending", models.Outbox.kind == kind)
+            .group_by(models.Outbox.chat_id, models.Outbox.doc_key)
+        ]
+        if not head_ids:
+            return []
+
+        return (
+            self.db_session.query(models.Outbox)
+            .filter(
+                models.Outbox.id.in_(head_ids),
+                models.Outbox.next_attempt_at <= datetime.now(),
+            )
+            .order_by(models.Outbox.id)
+            .all()
+        )
+
+    def _deliver_group(self, head):
+        head_id = head.id
+        try:
+            if head.kind == "doc_entry":
+                self._deliver_doc_entries(head)
+            elif head.kind == "media":
+                self._deliver_media(head)
+            else:
+                raise ValueError("Unknown outbox kind {!r}".format(head.kind))
+        except Exception as e:
+            self.db_session.rollback()
+            self._reschedule(head_id, e)
+
+    def _deliver_doc_entries(self, head):
+        rows = (
+            self.db_session.query(models.Outbox)
+            .filter(
+                models.Outbox.status == "pending",
+                models.Outbox.chat_id == head.chat_id,
+                models.Outbox.kind == head.kind,
+                models.Outbox.doc_key == head.doc_key,
+            )
+            .order_by(models.Outbox.id)
+            .limit(self.batch_size)
+            .all()
+        )
+
+        doc_id = self.conversation.day_resolver(head.chat_id).doc_id(
+            date.fromisoformat(head.doc_key)
+        )
+        self.conversation.goog_drive.write_document_batch(
+            document_id=doc_id, entries=[json.loads(row.payload) for row in rows]
+        )
+
+        for row in rows:
+            self.db_session.delete(row)
+        self.db_session.commit()
+
+    def _deliver_media(self, head):
+        chat_id = head.chat_id
+        payload = json.loads(head.payload)
+        if not payload.get("goog_id"):
+            if not os.path.exists(payload["path"]):
+                raise ValueError("Spooled media {} is missing".format(payload["path"]))
+
+            _, response = self.conversation.upload_media(
+                chat_id,
+                payload["path"],
+                payload["mimetype"],
+                file_name=payload["file_name"],
+                day=date.fromisoformat(head.doc_key),
+                remove_file=False,
+            )
+            # remember the drive file before the spool goes, so a failure
+            # below is retried without uploading again
+            payload["goog_id"] = response.get("id")
+            head.payload = json.dumps(payload)
+            self.db_session.commit()
+
+        if os.path.exists(payload["path"]):
+            os.remove(payload["path"])
+
+        # record_media commits, taking the outbox row with it
+        self.db_session.delete(head)
+        self.conversation.record_media(
+            chat_id,
+            payload["file_name"],
+            payload["goog_id"],
+            payload["mimetype"],
+            file_unique_id=payload.get("file_unique_id"),
+            content_hash=payload.get("content_hash"),
+            caption=payload.get("caption"),
+        )
+
+    def _reschedule(self, outbox_id, error):
+        row = self.db_session.query(models.Outbox).get(outbox_id)
+        row.attempts += 1
+        row.last_error = str(error)[:1000]
+
+        age = datetime.now() - (row.date or datetime.now())
+        if not is_retryable(error) or age >= self.max_age:
+            # give up on this row so it does not hold back the rest of its
+            # group; retrying a 4xx or a missing file cannot succeed
+            row.status = "dead"
+            logging.error(
+                "Dropping outbox row %s after %d attempts: %s",
+                outbox_id,
+                row.attempts,
+                error,
+            )
+            if row.kind == "media":
+                self._drop_media(row)
+        else:
+            delay = self.backoff_delay(row.attempts, error)
+            row.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+            logging.warning(
+                "Outbox row %s failed (%s), retrying in %.1fs", outbox_id, error, delay
+            )
+
+        self.db_session.commit()
+
+    def _drop_media(self, row):
+        # nothing will upload the spooled file any more
+        payload = json.loads(row.payload)
+        logging.error(
+            "Media %s for chat %s was not saved to Drive",
+            payload.get("file_name"),
+            row.chat_id,
+        )
+        if payload.get("path") and os.path.exists(payload["path"]):
+            os.remove(payload["path"])
+
+    def backoff_delay(self, attempts, error=None):
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return max(retry_after, 1.0)
+
+        # the exponent is capped so days of retries cannot overflow a float
+        delay = min(self.base_delay * 2 ** min(attempts - 1, 32), self.max_delay)
+        return random.uniform(delay / 2, delay)
+
+
+def is_retryable(error):
+    # OperationalError covers a locked or busy journal.sqlite
+    return is_transient_error(error) or isinstance(error, OperationalError)
+
+
+def _retry_after(error):
+    if not isinstance(error, HttpError):
+        return None
+
+    try:
+        return float(error.resp.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
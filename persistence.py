@@ -0,0 +1,167 @@
+import asyncio
+import hashlib
+import json
+import pickle
+from datetime import datetime
+
+from database import engine
+from sqlalchemy import text
+from telegram.ext import BasePersistence
+
+SELECT_STATE = text("SELECT key, value FROM bot_state WHERE kind = :kind")
+UPSERT_STATE = text(
+    "INSERT INTO bot_state (kind, key, value, date) "
+    "VALUES (:kind, :key, :value, :date) "
+    "ON CONFLICT (kind, key) DO UPDATE SET value = excluded.value, date = excluded.date"
+)
+DELETE_STATE = text("DELETE FROM bot_state WHERE kind = :kind AND key = :key")
+
+
+class SQLitePersistence(BasePersistence):
+    # Keeps user_data, chat_data, bot_data and conversation states in the
+    # bot_state table of journal.sqlite, one row per user, chat or
+    # conversation key. A value is only written when its pickled bytes differ
+    # from what was last loaded or saved, and every write is its own
+    # transaction, so a flush costs one small row per changed chat instead of
+    # rewriting the state of every chat.
+
+    def __init__(self, store_data=None, update_interval=60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self._digests = {}
+
+    async def get_user_data(self):
+        data = await asyncio.to_thread(self._load, "user_data")
+        return {int(key): value for key, value in data.items()}
+
+    async def get_chat_data(self):
+        data = await asyncio.to_thread(self._load, "chat_data")
+        return {int(key): value for key, value in data.items()}
+
+    async def get_bot_data(self):
+        data = await asyncio.to_thread(self._load, "bot_data")
+        return data.get("", {})
+
+    async def get_callback_data(self):
+        data = await asyncio.to_thread(self._load, "callback_data")
+        return data.get("")
+
+    async def get_conversations(self, name):
+        # conversation states are only read for handlers marked persistent
+        data = await asyncio.to_thread(self._load, conversation_kind(name))
+        return {tuple(json.loads(key)): state for key, state in data.items()}
+
+    async def update_user_data(self, user_id, data):
+        await self._save("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._save("chat_data", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        await self._save("bot_data", "", data)
+
+    async def update_callback_data(self, data):
+        await self._save("callback_data", "", data)
+
+    async def update_conversation(self, name, key, new_state):
+        kind = conversation_kind(name)
+        if new_state is None:
+            await self._drop(kind, json.dumps(list(key)))
+        else:
+            await self._save(kind, json.dumps(list(key)), new_state)
+
+    async def drop_user_data(self, user_id):
+        await self._drop("user_data", str(user_id))
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop("chat_data", str(chat_id))
+
+    # the in-memory copies are authoritative, nothing else writes bot_state
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # every update is committed as it happens
+        pass
+
+    def _load(self, kind):
+        with engine.connect() as connection:
+            rows = connection.execute(SELECT_STATE, {"kind": kind}).fetchall()
+
+        data = {}
+        for key, value in rows:
+            self._digests[(kind, key)] = _digest(value)
+            data[key] = pickle.loads(value)
+        return data
+
+    async def _save(self, kind, key, data):
+        value = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        digest = _digest(value)
+        if self._digests.get((kind, key)) == digest:
+            return
+
+        await asyncio.to_thread(
+            _execute,
+            UPSERT_STATE,
+            {"kind": kind, "key": key, "value": value, "date": datetime.now()},
+        )
+        self._digests[(kind, key)] = digest
+
+    async def _drop(self, kind, key):
+        if self._digests.pop((kind, key), None) is None:
+            return
+        await asyncio.to_thread(_execute, DELETE_STATE, {"kind": kind, "key": key})
+
+
+class _PickleFileUnpickler(pickle.Unpickler):
+    # PicklePersistence stores the Bot instance as a persistent id; there is
+    # no bot while migrating, so references to it are dropped
+    def persistent_load(self, pid):
+        return None
+
+
+def pickle_file_rows(filepath):
+    # (kind, key, value) rows for the state saved by a single-file
+    # PicklePersistence, encoded the way SQLitePersistence stores them
+    with open(filepath, "rb") as fp:
+        state = _PickleFileUnpickler(fp).load()
+
+    for kind in ("user_data", "chat_data"):
+        for key, value in (state.get(kind) or {}).items():
+            yield kind, str(key), _dumps(value)
+
+    if state.get("bot_data") is not None:
+        yield "bot_data", "", _dumps(state["bot_data"])
+    if state.get("callback_data") is not None:
+        yield "callback_data", "", _dumps(state["callback_data"])
+
+    for name, conversations in (state.get("conversations") or {}).items():
+        for key, conversation_state in conversations.items():
+            if conversation_state is not None:
+                yield (
+                    conversation_kind(name),
+                    json.dumps(list(key)),
+                    _dumps(conversation_state),
+                )
+
+
+def conversation_kind(name):
+    return "conversation:{}".format(name)
+
+
+def _dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _digest(value):
+    return hashlib.sha1(value).digest()
+
+
+def _execute(statement, params):
+    with engine.begin() as connection:
+        connection.execute(statement, params)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+
+
+class ReflectionDeck(object):
+    # Reflection questions loaded once and reloaded only when the file's mtime
+    # changes. Each chat keeps its own shuffled order and cursor (a plain dict
+    # stored in chat_data), so every question is asked once before any repeat.
+    #
+    # Plain text files hold one question per line. A .json file holds a list
+    # of questions, each either a string or an object such as
+    # {"question": "...", "category": "gratitude", "weight": 2}; higher
+    # weights are drawn earlier in each pass through the deck.
+
+    def __init__(self, path):
+        self.path = path
+        self.questions = []
+        self.version = None
+        self._mtime = None
+        self._load_if_changed()
+
+    def _load_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            logging.warning("Reflection questions file %s is missing", self.path)
+            return
+
+        if mtime == self._mtime:
+            return
+
+        try:
+            questions = self._read()
+        except (OSError, ValueError) as e:
+            # e.g. a half-saved file; it gets a new mtime once it is fixed
+            logging.warning(
+                "Could not load reflection questions from %s (%s), keeping the "
+                "previous %d",
+                self.path,
+                e,
+                len(self.questions),
+            )
+            self._mtime = mtime
+            return
+
+        self.questions = [q for q in questions if q and q["question"]]
+        self.version = hashlib.sha1(
+            json.dumps(self.questions, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        self._mtime = mtime
+
+    def _read(self):
+        with open(self.path, "r") as fp:
+            if not self.path.endswith(".json"):
+                return [
+                    {"question": line.strip(), "category": None, "weight": 1.0}
+                    for line in fp
+                ]
+            entries = json.load(fp)
+
+        if not isinstance(entries, list):
+            raise ValueError("expected a list of questions")
+        questions = [_parse_entry(entry) for entry in entries]
+        skipped = questions.count(None)
+        if skipped:
+            logging.warning(
+                "Skipped %d malformed reflection questions in %s", skipped, self.path
+            )
+        return questions
+
+    def categories(self):
+        self._load_if_changed()
+        return sorted({q["category"] for q in self.questions if q["category"]})
+
+    def draw(self, state, category=None):
+        # state is mutated in place: {category or "*": {"version", "order",
+        # "position"}}
+        self._load_if_changed()
+
+        cursor = state.setdefault(category or "*", {})
+        if (
+            cursor.get("version") != self.version
+            or cursor.get("position", 0) >= len(cursor.get("order", []))
+        ):
+            cursor["version"] = self.version
+            cursor["order"] = self._shuffled(category)
+            cursor["position"] = 0
+
+        if not cursor["order"]:
+            return ""
+
+        question = self.questions[cursor["order"][cursor["position"]]]
+        cursor["position"] += 1
+        return question["question"]
+
+    def _shuffled(self, category):
+        # weighted shuffle: sort by u ** (1 / weight) for uniform u
+        keyed = [
+            (random.random() ** (1.0 / q["weight"]), index)
+            for index, q in enumerate(self.questions)
+            if category is None or q["category"] == category
+        ]
+        keyed.sort(reverse=True)
+        return [index for _, index in keyed]
+
+
+def _parse_entry(entry):
+    # None for anything that is not a usable question
+    if isinstance(entry, str):
+        return {"question": entry.strip(), "category": None, "weight": 1.0}
+    if not isinstance(entry, dict) or not isinstance(entry.get("question"), str):
+        return None
+
+    try:
+        weight = float(entry.get("weight", 1))
+    except (TypeError, ValueError):
+        weight = 1.0
+    if not (weight > 0 and math.isfinite(weight)):
+        return None
+
+    category = entry.get("category")
+    return {
+        "question": entry["question"].strip(),
+        "category": category if isinstance(category, str) else None,
+        "weight": weight,
+    }
@@ -0,0 +1,34 @@
+import time
+
+from metrics import TELEGRAM_ERRORS, TELEGRAM_SEND_SECONDS
+from telegram.request import HTTPXRequest
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    # HTTPXRequest that records the latency of every bot API call (replies,
+    # prompts, file downloads) by method name. getUpdates is a long poll, so
+    # the updater gets a plain HTTPXRequest of its own.
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = _api_method(url)
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(
+                url, method, request_data=request_data, **kwargs
+            )
+        except Exception:
+            TELEGRAM_ERRORS.inc(api_method)
+            raise
+        finally:
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started, api_method)
+
+        if code >= 400:
+            TELEGRAM_ERRORS.inc(api_method)
+        return code, payload
+
+
+def _api_method(url):
+    # file downloads end in the file path, keep them to one label
+    if "/file/bot" in url:
+        return "downloadFile"
+    return url.rsplit("/", 1)[-1]
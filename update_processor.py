@@ -0,0 +1,68 @@
+import logging
+import os
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Processes updates from different chats concurrently, up to
+    # max_concurrent_updates at a time, while updates from the same chat run
+    # one after another in the order they arrived. That keeps each chat's
+    # journal entries in order and its ConversationHandler state consistent.
+    #
+    # An update for a chat that is already being processed is queued behind
+    # it and returns its concurrency slot at once; the chat's running update
+    # works through the queue, so a busy chat holds a single slot instead of
+    # one per waiting update.
+
+    def __init__(self, max_concurrent_updates=None):
+        if max_concurrent_updates is None:
+            max_concurrent_updates = int(os.getenv("MAX_CONCURRENT_UPDATES", "16"))
+
+        super().__init__(max(max_concurrent_updates, 1))
+        # chat key -> coroutines waiting behind the chat's running update
+        self._chat_queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = chat_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        waiting = self._chat_queues.get(key)
+        if waiting is not None:
+            waiting.append(coroutine)
+            return
+
+        waiting = self._chat_queues[key] = deque([coroutine])
+        try:
+            while waiting:
+                try:
+                    await waiting.popleft()
+                except Exception:
+                    # Application.process_update reports handler errors
+                    # itself, this only keeps the rest of the queue going
+                    logging.exception("Processing an update for %s failed", key)
+        finally:
+            del self._chat_queues[key]
+            for coroutine in waiting:
+                # cancelled while updates were queued behind this one
+                coroutine.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+def chat_key(update):
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return ("chat", chat.id)
+
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return ("user", user.id)
+    return None
@@ -1,5 +1,6 @@
 from datetime import datetime
-import pytz
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 
 def hex_to_rgb(hex):
   rgb = []
@@ -10,10 +11,15 @@ def hex_to_rgb(hex):
   return tuple(rgb)
 
 
+@lru_cache(maxsize = None)
+def get_timezone(name):
+    # zone objects are immutable, so each name is only parsed once
+    return ZoneInfo(name)
+
+
 def period_of_day(timezone = ''):
     if timezone:
-        IST = pytz.timezone(timezone)
-        now = datetime.now(IST)
+        now = datetime.now(get_timezone(timezone))
     else:
         now = datetime.now()
 
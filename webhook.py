@@ -0,0 +1,91 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+import tornado.web
+from telegram import Update
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    # receives updates pushed by telegram and queues them for the bot
+    # application (self.application is tornado's own)
+    def initialize(self, bot_application, secret_token):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+
+    async def post(self):
+        token = self.request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token, self.secret_token):
+            logging.warning("Rejected webhook call without a valid secret token")
+            raise tornado.web.HTTPError(403)
+
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, self.bot_application.bot)
+        except (TypeError, ValueError):
+            raise tornado.web.HTTPError(400)
+
+        if update is not None:
+            await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, bot_application):
+        self.bot_application = bot_application
+
+    def get(self):
+        running = self.bot_application.running
+        if not running:
+            self.set_status(503)
+        self.write({"status": "ok" if running else "starting"})
+
+
+async def run_webhook(application, listen, port, url_path, webhook_url, secret_token):
+    # Serves telegram updates and /healthz from one tornado server, the
+    # equivalent of Application.run_webhook plus a health endpoint. Metrics
+    # stay on METRICS_PORT, since nginx makes this port public. Runs until
+    # SIGINT or SIGTERM.
+    server = tornado.web.Application(
+        [
+            (r"/healthz", HealthHandler, {"bot_application": application}),
+            (
+                r"/{}/?".format(url_path.strip("/")),
+                TelegramWebhookHandler,
+                {"bot_application": application, "secret_token": secret_token},
+            ),
+        ]
+    ).listen(port, address=listen, xheaders=True)
+
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_signal.set)
+
+    try:
+        async with application:
+            try:
+                if application.post_init:
+                    await application.post_init(application)
+                await application.bot.set_webhook(
+                    url=webhook_url,
+                    secret_token=secret_token,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+                await application.start()
+                logging.info("Listening for webhook calls on %s:%s", listen, port)
+
+                await stop_signal.wait()
+            finally:
+                server.stop()
+                if application.running:
+                    await application.stop()
+                    if application.post_stop:
+                        await application.post_stop(application)
+    finally:
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class WriteBehindQueue(object):
+    # jobs run one at a time on a dedicated thread, so entries land in the
+    # journal in the order the handlers queued them. Consecutive text entries
+    # arriving within the batch window are coalesced into one commit.
+
+    def __init__(
+        self,
+        conversation,
+        maxsize=None,
+        batch_window=None,
+        batch_size=None,
+        on_flush=None,
+    ):
+        self.conversation = conversation
+        # called on the event loop after each write, e.g. to wake the outbox
+        self.on_flush = on_flush
+        if maxsize is None:
+            maxsize = int(os.getenv("JOURNAL_QUEUE_MAXSIZE", "0"))
+        if batch_window is None:
+            batch_window = int(os.getenv("JOURNAL_BATCH_WINDOW_MS", "500")) / 1000
+        if batch_size is None:
+            batch_size = int(os.getenv("JOURNAL_BATCH_SIZE", "10"))
+
+        self.batch_window = batch_window
+        self.batch_size = max(batch_size, 1)
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="journal-writer"
+        )
+        self._worker = None
+        self._held_job = None
+
+    @property
+    def depth(self):
+        return self._queue.qsize() + (1 if self._held_job is not None else 0)
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is None:
+            return
+
+        # flush everything accepted before shutdown
+        if self.depth:
+            logging.info("Flushing %d queued journal writes", self.depth)
+        await self._queue.join()
+
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        self._executor.shutdown(wait=True)
+
+    # with a maxsize these wait for room in the queue, so a backlog slows the
+    # handlers down instead of dropping their entries
+
+    async def submit(self, func, *args, **kwargs):
+        await self._queue.put(partial(func, *args, **kwargs))
+
+    async def add_content(self, chat_id, speaker, message, category="", is_bot=False):
+        await self._queue.put(
+            {
+                "chat_id": chat_id,
+                "speaker": speaker,
+                "message": message,
+                "category": category,
+                "is_bot": is_bot,
+            }
+        )
+
+    async def add_media(self, *args, **kwargs):
+        await self.submit(self.conversation.add_media, *args, **kwargs)
+
+    async def _next_job(self, timeout=None):
+        if self._held_job is not None:
+            job, self._held_job = self._held_job, None
+            return job
+
+        if timeout is None:
+            return await self._queue.get()
+        if timeout <= 0:
+            return self._queue.get_nowait()
+        return await asyncio.wait_for(self._queue.get(), timeout)
+
+    async def _collect_entries(self, first_entry):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+        entries = [first_entry]
+
+        while len(entries) < self.batch_size:
+            try:
+                job = await self._next_job(timeout=deadline - loop.time())
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+
+            if not isinstance(job, dict):
+                # keep ordering: a media job ends the batch and runs next
+                self._held_job = job
+                break
+            entries.append(job)
+
+        return entries
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._next_job()
+            completed = 1
+            try:
+                if isinstance(job, dict):
+                    entries = await self._collect_entries(job)
+                    completed = len(entries)
+                    job = partial(self.conversation.add_contents, entries)
+
+                await loop.run_in_executor(self._executor, job)
+                if self.on_flush is not None:
+                    self.on_flush()
+            except Exception:
+                logging.exception("Journal write failed")
+            finally:
+                for _ in range(completed):
+                    self._queue.task_done()